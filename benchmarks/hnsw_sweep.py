@@ -0,0 +1,608 @@
+"""
+HNSW parameter sweep benchmark.
+
+Loads a synthetic (or previously saved) corpus of frame embeddings into
+Redis Stack, builds HNSW index for every combination of M and
+EF_CONSTRUCTION and measures build time, index memory, recall@k and query
+latency. Query-time parameters, EF_RUNTIME for KNN queries and EPSILON
+for range queries, are swept for every built index.
+
+Index may store compressed vectors, FLOAT16 and/or projected onto top
+principal directions like the web service does (`--type`, `--pca-dim`).
+KNN candidates found in such index are then re-ranked with full-precision
+embeddings for every oversampling factor. Recall of exact search over
+compressed vectors with the same re-ranking is computed with numpy, so the
+loss caused by compression is reported separately from the loss caused by
+HNSW, `--offline` computes only that and doesn't need Redis.
+
+Usage:
+```bash
+pip install -r benchmarks/requirements.txt
+python benchmarks/hnsw_sweep.py --host localhost --output report.json
+python benchmarks/hnsw_sweep.py --type FLOAT16 --pca-dim 128 --oversample 1 2 4
+```
+"""
+import argparse
+import json
+import math
+import platform
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+import numpy as np
+import redis
+
+
+PREFIX = 'hnsw_bench:'
+INDEX_NAME = 'hnsw_bench_idx'
+RETURN_FIELDS = ('source_manager_id', 'timestamp')
+DTYPES = {'FLOAT32': 'float32', 'FLOAT16': 'float16'}
+
+
+def generate_corpus(size: int, dim: int, tenants: int, clusters: int,
+                    days: float, seed: int) -> dict:
+    """
+    Generate synthetic corpus of frame embeddings.
+
+    Embeddings are L2-normalized samples from a mixture of gaussians, so
+    like CLIP embeddings of surveillance footage they form dense clusters
+    of similar scenes. Tenant sizes follow Zipf distribution: a few source
+    managers own most of the frames. Timestamps follow a diurnal cycle
+    with more frames during the day.
+
+    Parameters:
+    - size (int): number of frames
+    - dim (int): embedding dimension
+    - tenants (int): number of source managers
+    - clusters (int): number of scene clusters
+    - days (float): time span of the corpus in days
+    - seed (int): random seed
+
+    Returns:
+    - dict: `embeddings`, `tenants` and `timestamps` arrays
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype('float32')
+    weights = rng.dirichlet(np.ones(clusters))
+    labels = rng.choice(clusters, size=size, p=weights)
+    embeddings = centers[labels] + rng.normal(
+        scale=0.5, size=(size, dim)
+    ).astype('float32')
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    tenant_weights = 1 / np.arange(1, tenants + 1) ** 1.2
+    tenant_weights /= tenant_weights.sum()
+    tenant_ids = rng.choice(tenants, size=size, p=tenant_weights)
+
+    hours = np.arange(24)
+    hour_weights = 1 + np.sin((hours - 6) / 24 * 2 * np.pi).clip(0) * 3
+    hour_weights /= hour_weights.sum()
+    day = rng.integers(0, max(int(days), 1), size=size)
+    hour = rng.choice(24, size=size, p=hour_weights)
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc).timestamp()
+    timestamps = start + day * 86400 + hour * 3600 \
+        + rng.uniform(0, 3600, size=size)
+
+    return {
+        'embeddings': embeddings.astype('float32'),
+        'tenants': tenant_ids.astype('int32'),
+        'timestamps': timestamps.astype('float64'),
+    }
+
+
+def generate_queries(corpus: dict, count: int, window_hours: list[float],
+                     seed: int) -> dict:
+    """
+    Generate queries: noisy copies of random corpus embeddings with tenant
+    of the copied frame and a time window around its timestamp.
+
+    Parameters:
+    - corpus (dict): corpus returned by `generate_corpus`
+    - count (int): number of queries
+    - window_hours (list[float]): widths of time windows to choose from
+    - seed (int): random seed
+
+    Returns:
+    - dict: `embeddings`, `tenants`, `time_start` and `time_end` arrays
+    """
+    rng = np.random.default_rng(seed + 1)
+    source = rng.choice(len(corpus['embeddings']), size=count)
+    embeddings = corpus['embeddings'][source] + rng.normal(
+        scale=0.05, size=(count, corpus['embeddings'].shape[1])
+    ).astype('float32')
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    width = rng.choice(window_hours, size=count) * 3600
+    center = corpus['timestamps'][source]
+    return {
+        'embeddings': embeddings.astype('float32'),
+        'tenants': corpus['tenants'][source],
+        'time_start': center - width / 2,
+        'time_end': center + width / 2,
+    }
+
+
+def distances(embeddings: np.ndarray, query: np.ndarray,
+              metric: str) -> np.ndarray:
+    """Distances in RediSearch conventions, lower is closer."""
+    if metric == 'L2':
+        return ((embeddings - query) ** 2).sum(axis=1)
+    if metric == 'COSINE':
+        norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query)
+        return 1 - embeddings @ query / np.maximum(norms, 1e-12)
+    return 1 - embeddings @ query
+
+
+def ground_truth(corpus: dict, queries: dict, k: int, metric: str,
+                 filtered: bool) -> tuple[list[np.ndarray], np.ndarray]:
+    """
+    Compute exact top-k with brute force.
+
+    Returns:
+    - list[np.ndarray]: ids of the closest frames of every query
+    - np.ndarray: distance to the k-th closest frame of every query
+    """
+    ids, radii = [], []
+    for i, query in enumerate(queries['embeddings']):
+        scores = distances(corpus['embeddings'], query, metric)
+        if filtered:
+            mask = (corpus['tenants'] == queries['tenants'][i]) \
+                & (corpus['timestamps'] >= queries['time_start'][i]) \
+                & (corpus['timestamps'] <= queries['time_end'][i])
+            scores = np.where(mask, scores, np.inf)
+        top = np.argpartition(scores, k - 1)[:k]
+        top = top[np.argsort(scores[top])]
+        top = top[np.isfinite(scores[top])]
+        ids.append(top)
+        radii.append(scores[top[-1]] if len(top) else 0.0)
+    return ids, np.array(radii)
+
+
+def fit_projection(embeddings: np.ndarray, dim: int, samples: int,
+                   seed: int) -> np.ndarray:
+    """
+    Fit projection onto top principal directions on a sample of the corpus,
+    the same way as the web service does: vectors are not centered.
+
+    Returns:
+    - np.ndarray: projection matrix of shape (embedding dim, dim)
+    """
+    rng = np.random.default_rng(seed + 2)
+    sample = embeddings[rng.choice(
+        len(embeddings), size=min(samples, len(embeddings)), replace=False
+    )]
+    _, _, vt = np.linalg.svd(sample, full_matrices=False)
+    return np.ascontiguousarray(vt[:dim].T, dtype='float32')
+
+
+def compress(embeddings: np.ndarray, type: str,
+             components: Optional[np.ndarray]) -> np.ndarray:
+    """Convert float32 embeddings into vectors stored in the index."""
+    if components is not None:
+        embeddings = embeddings @ components
+    return embeddings.astype(DTYPES[type])
+
+
+def rerank(corpus: dict, ids: np.ndarray, query: np.ndarray, k: int,
+           metric: str) -> np.ndarray:
+    """Order candidates by exact distance to the query, keep top k."""
+    scores = distances(corpus['embeddings'][ids], query, metric)
+    return ids[np.argsort(scores, kind='stable')[:k]]
+
+
+def compression_recall(corpus: dict, queries: dict, indexed: dict,
+                       indexed_queries: dict, truth: list[np.ndarray],
+                       k: int, candidates: int, metric: str,
+                       filtered: bool) -> float:
+    """
+    Recall@k of exact search over compressed vectors followed by
+    re-ranking of `candidates` found frames, an upper bound of recall of
+    HNSW index over the same vectors.
+    """
+    found, _ = ground_truth(indexed, indexed_queries, candidates, metric,
+                            filtered)
+    recalls = []
+    for i, query in enumerate(queries['embeddings']):
+        if len(truth[i]):
+            top = rerank(corpus, found[i], query, k, metric)
+            recalls.append(len(set(top) & set(truth[i])) / len(truth[i]))
+    return round(float(np.mean(recalls)), 4)
+
+
+def load(connection: redis.Redis, corpus: dict,
+         vectors: Optional[np.ndarray] = None, batch_size: int = 1000):
+    """
+    Write corpus into Redis hashes, with compressed vectors in `vector`
+    field if they are given.
+    """
+    pipe = connection.pipeline(transaction=False)
+    for i in range(len(corpus['embeddings'])):
+        mapping = {
+            'source_manager_id': int(corpus['tenants'][i]),
+            'timestamp': float(corpus['timestamps'][i]),
+            'embedding': corpus['embeddings'][i].tobytes(),
+        }
+        if vectors is not None:
+            mapping['vector'] = vectors[i].tobytes()
+        pipe.hset(f'{PREFIX}{i}', mapping=mapping)
+        if (i + 1) % batch_size == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def cleanup(connection: redis.Redis, batch_size: int = 1000):
+    """Drop benchmark index and delete corpus hashes."""
+    try:
+        connection.execute_command('FT.DROPINDEX', INDEX_NAME)
+    except redis.ResponseError:
+        pass
+    keys = []
+    for key in connection.scan_iter(f'{PREFIX}*', batch_size):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            connection.delete(*keys)
+            keys = []
+    if keys:
+        connection.delete(*keys)
+
+
+def info(connection: redis.Redis) -> dict:
+    reply = connection.execute_command('FT.INFO', INDEX_NAME)
+    return dict(zip(reply[::2], reply[1::2]))
+
+
+def build(connection: redis.Redis, field: str, type: str, dim: int,
+          metric: str, m: int, ef_construction: int,
+          poll_interval: float) -> dict:
+    """
+    Build index over loaded corpus and wait until it's fully indexed.
+
+    Returns:
+    - dict: build time and index memory reported by FT.INFO
+    """
+    try:
+        connection.execute_command('FT.DROPINDEX', INDEX_NAME)
+    except redis.ResponseError:
+        pass
+    start = time.perf_counter()
+    connection.execute_command(
+        'FT.CREATE', INDEX_NAME, 'ON', 'HASH', 'PREFIX', 1, PREFIX,
+        'SCHEMA',
+        'source_manager_id', 'TAG',
+        'timestamp', 'NUMERIC',
+        field, 'VECTOR', 'HNSW', 10,
+        'TYPE', type,
+        'DIM', dim,
+        'DISTANCE_METRIC', metric,
+        'M', m,
+        'EF_CONSTRUCTION', ef_construction,
+    )
+    while True:
+        index = info(connection)
+        if int(index[b'indexing']) == 0 \
+                and float(index[b'percent_indexed']) >= 1:
+            break
+        time.sleep(poll_interval)
+    build_seconds = time.perf_counter() - start
+    return {
+        'build_seconds': round(build_seconds, 3),
+        'num_docs': int(index[b'num_docs']),
+        'vector_index_mb': float(index.get(b'vector_index_sz_mb', 0)),
+        'total_index_mb': float(index.get(b'vector_index_sz_mb', 0))
+        + float(index.get(b'inverted_sz_mb', 0))
+        + float(index.get(b'offset_vectors_sz_mb', 0))
+        + float(index.get(b'doc_table_size_mb', 0))
+        + float(index.get(b'sortable_values_size_mb', 0))
+        + float(index.get(b'key_table_size_mb', 0)),
+    }
+
+
+def query_filter(queries: dict, i: int, filtered: bool) -> str:
+    if not filtered:
+        return '*'
+    return '(@source_manager_id:{{{}}} @timestamp:[{} {}])'.format(
+        queries['tenants'][i], queries['time_start'][i],
+        queries['time_end'][i],
+    )
+
+
+def decode_ids(reply: list) -> list[int]:
+    return [int(key[len(PREFIX):]) for key in reply[1::2]]
+
+
+def summary(recalls: list[float], latencies: list[float]) -> dict:
+    latencies = np.array(latencies) * 1000
+    return {
+        'recall': round(float(np.mean(recalls)), 4),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+    }
+
+
+def run_knn(connection: redis.Redis, corpus: dict, queries: dict,
+            indexed_queries: dict, truth: list, field: str, type: str,
+            k: int, candidates: int, ef_runtime: int, metric: str,
+            filtered: bool) -> dict:
+    """
+    Run KNN queries one by one and measure recall@k and latency.
+    If more than k candidates are fetched, they are re-ranked with
+    full-precision embeddings, which is included in the latency.
+    """
+    recalls, latencies = [], []
+    for i, embedding in enumerate(indexed_queries['embeddings']):
+        query = (
+            f'{query_filter(queries, i, filtered)}=>[KNN {candidates} '
+            f'@{field} $vec EF_RUNTIME {ef_runtime} AS score]'
+        )
+        start = time.perf_counter()
+        reply = connection.execute_command(
+            'FT.SEARCH', INDEX_NAME, query,
+            'RETURN', 1, 'score', 'SORTBY', 'score', 'LIMIT', 0, candidates,
+            'PARAMS', 2, 'vec', embedding.astype(DTYPES[type]).tobytes(),
+            'DIALECT', 2,
+        )
+        found = np.array(decode_ids(reply), dtype='int64')
+        if candidates > k:
+            found = rerank(corpus, found, queries['embeddings'][i], k,
+                           metric)
+        latencies.append(time.perf_counter() - start)
+        if len(truth[i]):
+            recalls.append(len(set(found) & set(truth[i])) / len(truth[i]))
+    return summary(recalls, latencies)
+
+
+def run_range(connection: redis.Redis, corpus: dict, queries: dict,
+              radii: np.ndarray, field: str, type: str, metric: str,
+              epsilon: float) -> dict:
+    """
+    Run unfiltered range queries with radius of the exact k-th neighbour
+    and measure share of frames within radius which are found. Corpus and
+    queries are the indexed vectors, so with compression this measures
+    only the loss caused by HNSW.
+    """
+    recalls, latencies = [], []
+    for i, embedding in enumerate(queries['embeddings']):
+        query = (
+            f'@{field}:[VECTOR_RANGE $radius $vec]'
+            f'=>{{$EPSILON: {epsilon}; $YIELD_DISTANCE_AS: score}}'
+        )
+        start = time.perf_counter()
+        reply = connection.execute_command(
+            'FT.SEARCH', INDEX_NAME, query,
+            'RETURN', 1, 'score', 'LIMIT', 0, 10000,
+            'PARAMS', 4, 'radius', float(radii[i]),
+            'vec', embedding.astype(DTYPES[type]).tobytes(), 'DIALECT', 2,
+        )
+        latencies.append(time.perf_counter() - start)
+        scores = distances(corpus['embeddings'], embedding, metric)
+        expected = set(np.flatnonzero(scores <= radii[i]))
+        if expected:
+            found = set(decode_ids(reply))
+            recalls.append(len(found & expected) / len(expected))
+    return summary(recalls, latencies)
+
+
+def server_info(connection: redis.Redis) -> dict:
+    """Redis and RediSearch versions, so reports are comparable."""
+    modules = {}
+    for module in connection.module_list():
+        module = {
+            k.decode() if isinstance(k, bytes) else k: v
+            for k, v in module.items()
+        }
+        name = module['name']
+        modules[name.decode() if isinstance(name, bytes) else name] = \
+            module['ver']
+    return {
+        'redis_version': connection.info('server')['redis_version'],
+        'search_version': modules.get('search'),
+    }
+
+
+def parse_args(args: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=0)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--output', default='hnsw_sweep.json',
+                        help='path of JSON report')
+    parser.add_argument('--corpus', default=None,
+                        help='load corpus from .npz file instead of '
+                             'generating it')
+    parser.add_argument('--save-corpus', default=None,
+                        help='save generated corpus and queries to .npz file')
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--tenants', type=int, default=20)
+    parser.add_argument('--clusters', type=int, default=256)
+    parser.add_argument('--days', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--window-hours', type=float, nargs='+',
+                        default=[1, 24, 24 * 7])
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--metric', default='IP',
+                        choices=['L2', 'IP', 'COSINE'])
+    parser.add_argument('--type', default='FLOAT32', choices=list(DTYPES),
+                        help='element type of vectors in the index')
+    parser.add_argument('--pca-dim', type=int, default=None,
+                        help='project vectors in the index onto this many '
+                             'principal directions')
+    parser.add_argument('--pca-samples', type=int, default=50000)
+    parser.add_argument('--oversample', type=float, nargs='+',
+                        default=[1, 2, 4],
+                        help='candidates fetched per result to re-rank, '
+                             'used only with compressed vectors')
+    parser.add_argument('--m', type=int, nargs='+', default=[16, 40])
+    parser.add_argument('--ef-construction', type=int, nargs='+',
+                        default=[100, 200])
+    parser.add_argument('--ef-runtime', type=int, nargs='+',
+                        default=[10, 50, 100, 200])
+    parser.add_argument('--epsilon', type=float, nargs='+',
+                        default=[0.01, 0.1, 0.8])
+    parser.add_argument('--poll-interval', type=float, default=1)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep corpus in Redis after benchmark')
+    parser.add_argument('--offline', action='store_true',
+                        help="only compute recall of exact search over "
+                             "compressed vectors, don't use Redis")
+    return parser.parse_args(args)
+
+
+def main(args: Optional[list[str]] = None):
+    args = parse_args(args)
+
+    if args.corpus:
+        data = dict(np.load(args.corpus))
+        corpus = {
+            name: data[name]
+            for name in ('embeddings', 'tenants', 'timestamps')
+        }
+        queries = {
+            name: data[f'query_{name}']
+            for name in ('embeddings', 'tenants', 'time_start', 'time_end')
+        }
+    else:
+        corpus = generate_corpus(args.size, args.dim, args.tenants,
+                                 args.clusters, args.days, args.seed)
+        queries = generate_queries(corpus, args.queries, args.window_hours,
+                                   args.seed)
+        if args.save_corpus:
+            np.savez(args.save_corpus, **corpus, **{
+                f'query_{name}': value for name, value in queries.items()
+            })
+    size, dim = corpus['embeddings'].shape
+
+    components = None
+    if args.pca_dim is not None and args.pca_dim != dim:
+        print(f'Fitting projection onto {args.pca_dim} directions')
+        components = fit_projection(corpus['embeddings'], args.pca_dim,
+                                    args.pca_samples, args.seed)
+    compressed = args.type != 'FLOAT32' or components is not None
+    vectors = compress(corpus['embeddings'], args.type, components)
+    # Distances are computed in float32, conversion from float16 is exact
+    indexed = {**corpus, 'embeddings': vectors.astype('float32')}
+    indexed_queries = {**queries, 'embeddings': compress(
+        queries['embeddings'], args.type, components
+    ).astype('float32')}
+    field = 'vector' if compressed else 'embedding'
+    oversample = args.oversample if compressed else [1]
+
+    print(f'Computing ground truth for {len(queries["embeddings"])} queries')
+    truth = {
+        'unfiltered': ground_truth(corpus, queries, args.k, args.metric,
+                                   filtered=False),
+        'filtered': ground_truth(corpus, queries, args.k, args.metric,
+                                 filtered=True),
+    }
+    compression = []
+    if compressed:
+        for factor in oversample:
+            candidates = math.ceil(args.k * factor)
+            compression.append({
+                'oversample': factor,
+                **{
+                    kind: compression_recall(
+                        corpus, queries, indexed, indexed_queries,
+                        truth[kind][0], args.k, candidates, args.metric,
+                        kind == 'filtered',
+                    )
+                    for kind in ('unfiltered', 'filtered')
+                },
+            })
+            print(f'Exact search over compressed vectors, oversample '
+                  f'{factor}: {compression[-1]}')
+
+    results = []
+    server = None
+    if not args.offline:
+        connection = redis.Redis(
+            host=args.host, port=args.port, db=args.db,
+            password=args.password,
+        )
+        server = server_info(connection)
+        # Range queries are compared with exact search over indexed vectors
+        radii = ground_truth(indexed, indexed_queries, args.k, args.metric,
+                             filtered=False)[1]
+
+        print(f'Loading {size} frames')
+        cleanup(connection)
+        load(connection, corpus, vectors if compressed else None)
+
+        try:
+            for m in args.m:
+                for ef_construction in args.ef_construction:
+                    print(f'Building index M={m} '
+                          f'EF_CONSTRUCTION={ef_construction}')
+                    result = {'m': m, 'ef_construction': ef_construction}
+                    result.update(build(
+                        connection, field, args.type, vectors.shape[1],
+                        args.metric, m, ef_construction, args.poll_interval,
+                    ))
+                    result['knn'] = [
+                        {
+                            'ef_runtime': ef_runtime,
+                            'oversample': factor,
+                            **{
+                                kind: run_knn(
+                                    connection, corpus, queries,
+                                    indexed_queries, truth[kind][0], field,
+                                    args.type, args.k,
+                                    math.ceil(args.k * factor), ef_runtime,
+                                    args.metric, kind == 'filtered',
+                                )
+                                for kind in ('unfiltered', 'filtered')
+                            },
+                        }
+                        for ef_runtime in args.ef_runtime
+                        for factor in oversample
+                    ]
+                    result['range'] = [
+                        {
+                            'epsilon': epsilon,
+                            **run_range(connection, indexed, indexed_queries,
+                                        radii, field, args.type,
+                                        args.metric, epsilon),
+                        }
+                        for epsilon in args.epsilon
+                    ]
+                    results.append(result)
+        finally:
+            if not args.keep:
+                cleanup(connection)
+
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'machine': platform.platform(),
+        'server': server,
+        'corpus': {
+            'source': args.corpus or 'synthetic',
+            'size': size,
+            'dim': dim,
+            'tenants': int(len(np.unique(corpus['tenants']))),
+            'clusters': None if args.corpus else args.clusters,
+            'days': None if args.corpus else args.days,
+            'seed': None if args.corpus else args.seed,
+        },
+        'queries': {
+            'count': len(queries['embeddings']),
+            'k': args.k,
+            'metric': args.metric,
+            'window_hours': None if args.corpus else args.window_hours,
+        },
+        'index': {
+            'type': args.type,
+            'dim': int(vectors.shape[1]),
+            'pca_samples': None if components is None else args.pca_samples,
+        },
+        'compression': compression,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f'Report written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
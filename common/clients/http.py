@@ -58,13 +58,13 @@ class ClientSession:
 
     def _safe_request(self, method: str,
                       url: str, **kwargs) -> requests.Response:
-        """Make request with retries and timeout."""
+        """Make request with retries and timeout.
+        Timeout can be overridden with `timeout` keyword argument."""
+        kwargs.setdefault('timeout', self.timeout)
         retries = self.max_retries
         while retries > 0:
             try:
-                return requests.request(
-                    method, url, timeout=self.timeout, **kwargs
-                )
+                return requests.request(method, url, **kwargs)
             except requests.exceptions.RequestException:
                 retries -= 1
         raise requests.exceptions.RequestException()
@@ -24,8 +24,22 @@ class WebSettings(BaseModel):
     jwt_algorithm: Literal['HS256'] = 'HS256'
     jwt_access_token_expire_minutes: PositiveInt = 60 * 24 * 7  # 7 days
 
+    vector_store: Literal[
+        'redisearch', 'redisearch-partitioned', 'flat'
+    ] = 'redisearch'
+    flat_store_dir: Path = Path('./flat_store')
+    flat_sync_interval: float = Field(5, ge=0)
+    flat_chunk_size: PositiveInt = 65536
+
+    # Rebuild index in background if its parameters have changed
     hnsw_recreate_index_on_startup: bool = False
+    hnsw_reindex_poll_interval: float = Field(5, gt=0)
+    hnsw_type: Literal['FLOAT32', 'FLOAT16'] = 'FLOAT32'
     hnsw_dim: PositiveInt = 512
+    hnsw_pca_dim: Optional[PositiveInt] = None  # Project vectors if set
+    hnsw_pca_samples: PositiveInt = 50000
+    hnsw_rerank_oversample: float = Field(4, ge=1)
+    hnsw_compress_interval: float = Field(10, gt=0)
     hnsw_distance_metric: Literal['L2', 'IP', 'COSINE'] = 'IP'
     hnsw_initial_cap: PositiveInt = 50000
     hnsw_m: PositiveInt = 40
@@ -33,11 +47,84 @@ class WebSettings(BaseModel):
     hnsw_ef_runtime: PositiveInt = 100
     hnsw_epsilon: float = 0.8
 
+    hybrid_planning: bool = True
+    hybrid_histogram_bucket: PositiveInt = 60 * 60  # 1 hour
+    hybrid_histogram_ttl: PositiveInt = 60 * 5  # 5 minutes
+    hybrid_histogram_max_buckets: PositiveInt = 24 * 365 * 10
+    hybrid_histogram_timeout: PositiveInt = 10000  # Milliseconds
+    hybrid_adhoc_bf_max: int = Field(20000, ge=0)
+    hybrid_batch_margin: float = Field(1.5, ge=1)
+    hybrid_max_batch_size: PositiveInt = 2000
+
+    search_cache_enabled: bool = True
+    search_cache_open_ttl: PositiveInt = 60
+    search_cache_closed_ttl: PositiveInt = 60 * 60 * 24
+    search_cache_closed_after: PositiveInt = 60 * 10  # 10 minutes
+
+    search_cursor_ttl: PositiveInt = 60 * 30  # 30 minutes
+    search_cursor_prefetch: PositiveInt = 2  # Pages fetched at once
+    search_cursor_max_depth: PositiveInt = 1000
+    search_page_max_size: PositiveInt = 10  # Maximal top-k of a page
+
+    frame_fetch_concurrency: PositiveInt = 8
+    frame_fetch_timeout: float = Field(5, gt=0)
+    # How long to use single-frame requests after multi-frame route is
+    # found missing, so updated source managers are noticed
+    frame_multi_route_ttl: PositiveInt = 60 * 10
+
+    # Rendered search result images, stored under `paths.media_dir`
+    thumbnail_cache_enabled: bool = True
+    thumbnail_cache_memory_size: PositiveInt = 64 * 2**20  # 64 MiB
+    thumbnail_cache_disk_size: PositiveInt = 2 * 2**30  # 2 GiB
+    thumbnail_max_age: PositiveInt = 60 * 60 * 24 * 7  # Browser cache
+    thumbnail_format: Literal['JPEG', 'WEBP', 'PNG'] = 'JPEG'
+    thumbnail_quality: int = Field(80, ge=1, le=100)  # JPEG and WEBP only
+    thumbnail_max_width: PositiveInt = 640
+    thumbnail_max_height: PositiveInt = 480
+
 
 class EncoderSettings(BaseModel):
     url: str = 'http://encoder:8080'
     model: str = 'openai/clip-vit-base-patch32'
 
+    host: str = '0.0.0.0'
+    port: PositiveInt = 8080
+    workers: PositiveInt = 1
+    # Share preloaded ONNX weights between workers, disables weight
+    # pre-packing, which makes batched inference slower
+    share_weights: bool = True
+
+    backend: Literal['tf', 'onnx', 'onnx-int8'] = 'tf'
+    intra_op_threads: int = Field(0, ge=0)  # 0 means number of cores
+    onnx_dir: Path = Path('/root/.cache/huggingface/hub/onnx')
+    onnx_parity_tolerance: float = Field(0.999, gt=0, le=1)
+    onnx_int8_parity_tolerance: float = Field(0.97, gt=0, le=1)
+
+    seq_len_buckets: list[PositiveInt] = [8, 16, 32, 77]
+    warmup_lengths: list[PositiveInt] = [8, 16, 32, 77]
+    warmup_batch_sizes: list[PositiveInt] = [1, 8]
+
+    prompt_ensemble: bool = False
+    prompt_templates: list[str] = [
+        '{}',
+        'a photo of {}.',
+        'a CCTV photo of {}.',
+        'a security camera footage of {}.',
+        'a surveillance camera frame showing {}.',
+        'a low resolution photo of {}.',
+    ]
+
+    batch_max_size: PositiveInt = 32
+    batch_max_wait_ms: float = Field(5, ge=0, le=1000)
+    queue_max_size: PositiveInt = 256
+    max_concurrency: PositiveInt = 1
+    retry_after_seconds: PositiveInt = 1
+
+    cache_enabled: bool = True
+    cache_local_size: PositiveInt = 1024
+    cache_local_ttl: PositiveInt = 60 * 60  # 1 hour
+    cache_redis_ttl: PositiveInt = 60 * 60 * 24 * 7  # 7 days
+
 
 class SearchEngineSettings(BaseModel):
     url: str = 'http://search_engine:8080'
@@ -63,6 +63,13 @@ class QuickstartUser(HttpUser):
         params = {'search_entry': generate_search_entry()}
         self.client.get('/search', params=params, name='/search')
 
+    @task(1)
+    def search_batch(self):
+        json = {
+            'search_entries': [generate_search_entry() for _ in range(4)],
+        }
+        self.client.post('/search/batch', json=json, name='/search/batch')
+
     @task(1)
     def index(self):
         self.client.get("/")
@@ -0,0 +1,422 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from transformers import CLIPTokenizerFast
+
+from common.config import settings
+from app import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# ONNX model without weights and its weights by initializer name, see
+# `ONNXBackend.preload`
+SharedModel = tuple[bytes, dict[str, np.ndarray]]
+
+# Texts used to check that exported model matches the original one
+PARITY_TEXTS = [
+    'a',
+    'red car',
+    'man with backpack',
+    'tall woman in a black coat walking a small dog',
+    'white truck parked in front of the gate at night',
+]
+
+
+def cosine_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Row-wise cosine similarity of two matrices."""
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+class BucketTokenizer:
+    """
+    Batched fast (Rust) CLIP tokenizer, which pads inputs to one of the
+    fixed lengths.
+
+    Padding to a small set of lengths keeps the number of distinct input
+    shapes low, so compiled graphs and memory plans are reused instead of
+    being rebuilt for every new shape.
+
+    Attributes:
+    - buckets (list[int]): allowed sequence lengths, the longest one is
+        the maximum sequence length, longer inputs are truncated
+    """
+
+    def __init__(self, model_id: str, buckets: list[int]):
+        self.buckets = sorted(buckets)
+        self.tokenizer = CLIPTokenizerFast.from_pretrained(model_id)
+
+    def bucket(self, length: int) -> int:
+        """Get the shortest bucket which fits sequence of given length."""
+        return next(b for b in self.buckets if b >= length)
+
+    def __call__(self, texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Tokenize texts.
+
+        Parameters:
+        - texts (list[str]): texts to tokenize
+
+        Returns:
+        - np.ndarray: int32 input ids of shape (len(texts), bucket)
+        - np.ndarray: int32 attention mask of shape (len(texts), bucket)
+        """
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.buckets[-1],
+            return_tensors='np',
+        )
+        input_ids = inputs['input_ids'].astype('int32')
+        attention_mask = inputs['attention_mask'].astype('int32')
+        pad = self.bucket(input_ids.shape[1]) - input_ids.shape[1]
+        if pad:
+            input_ids = np.pad(
+                input_ids, ((0, 0), (0, pad)),
+                constant_values=self.tokenizer.pad_token_id,
+            )
+            attention_mask = np.pad(attention_mask, ((0, 0), (0, pad)))
+        return input_ids, attention_mask
+
+
+class Backend:
+    """
+    Base class of inference backends.
+
+    Subclasses implement `forward`, while `encode` tokenizes texts and
+    keeps track of the time spent on tokenization and on forward pass.
+
+    Attributes:
+    - model_id (str): huggingface model id
+    - tokenizer (BucketTokenizer): tokenizer
+    """
+
+    def __init__(self, model_id: str):
+        self.model_id = model_id
+        self.tokenizer = BucketTokenizer(
+            model_id, settings.encoder.seq_len_buckets
+        )
+        self._stats_lock = threading.Lock()
+        self._stats = {'tokenize_seconds': 0.0, 'forward_seconds': 0.0}
+
+    def forward(self, input_ids: np.ndarray,
+                attention_mask: np.ndarray) -> np.ndarray:
+        raise NotImplementedError()
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        """
+        Encode texts with a single padded forward pass.
+
+        Parameters:
+        - texts (list[str]): texts to encode
+
+        Returns:
+        - np.ndarray: float32 matrix of shape (len(texts), dim)
+        """
+        start = time.perf_counter()
+        input_ids, attention_mask = self.tokenizer(texts)
+        tokenized = time.perf_counter()
+        embeddings = self.forward(input_ids, attention_mask)
+        done = time.perf_counter()
+        metrics.STAGE_LATENCY.labels('tokenize').observe(tokenized - start)
+        metrics.STAGE_LATENCY.labels('forward').observe(done - tokenized)
+        with self._stats_lock:
+            self._stats['tokenize_seconds'] += tokenized - start
+            self._stats['forward_seconds'] += done - tokenized
+        return embeddings.astype('float32')
+
+    def stats(self) -> dict:
+        """Get total time spent on each stage and tokenization share."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        total = stats['tokenize_seconds'] + stats['forward_seconds']
+        stats['tokenize_share'] = \
+            stats['tokenize_seconds'] / total if total else 0.0
+        return stats
+
+
+class TFBackend(Backend):
+    """
+    CLIP text tower running in TensorFlow.
+    Forward pass is compiled into a single graph accepting any input shape.
+    """
+
+    def __init__(self, model_id: str):
+        import tensorflow as tf
+        from transformers import TFCLIPModel
+
+        super().__init__(model_id)
+        if settings.encoder.intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(
+                settings.encoder.intra_op_threads
+            )
+        self.model = TFCLIPModel.from_pretrained(model_id)
+        self.input_signature = (
+            tf.TensorSpec((None, None), tf.int32, name='input_ids'),
+            tf.TensorSpec((None, None), tf.int32, name='attention_mask'),
+        )
+        self.text_features = tf.function(
+            self._text_features, input_signature=self.input_signature
+        )
+
+    def _text_features(self, input_ids, attention_mask):
+        return self.model.get_text_features(
+            input_ids=input_ids, attention_mask=attention_mask
+        )
+
+    def forward(self, input_ids: np.ndarray,
+                attention_mask: np.ndarray) -> np.ndarray:
+        return self.text_features(input_ids, attention_mask).numpy()
+
+
+class ONNXBackend(Backend):
+    """
+    CLIP text tower exported to ONNX and running in onnxruntime.
+
+    Model is exported from TensorFlow on first use and cached in
+    `settings.encoder.onnx_dir`, next starts load the cached artifact
+    without initializing TensorFlow at all.
+
+    Model can also be created from the model loaded with
+    `ONNXBackend.preload`. In this case session uses preloaded weight arrays
+    without copying them, so processes forked after preloading share one
+    copy of the weights. Weight pre-packing, which would make a packed copy
+    in every process, is disabled, so batched inference is slower.
+
+    Attributes:
+    - quantize (bool): use dynamically int8-quantized weights
+    """
+
+    def __init__(self, model_id: str, quantize: bool = False,
+                 shared_model: Optional[SharedModel] = None):
+        import onnxruntime as ort
+
+        super().__init__(model_id)
+        self.quantize = quantize
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = settings.encoder.intra_op_threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = \
+            ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if shared_model is not None:
+            model, weights = shared_model
+            options.add_session_config_entry('session.disable_prepacking', '1')
+            # Session doesn't own the values, they must outlive it
+            self._weights = {
+                name: ort.OrtValue.ortvalue_from_numpy(array)
+                for name, array in weights.items()
+            }
+            for name, value in self._weights.items():
+                options.add_initializer(name, value)
+        else:
+            path = self.artifact_path(model_id, quantize)
+            if not path.exists():
+                export(model_id, quantize)
+            model = str(path)
+        self.session = ort.InferenceSession(
+            model, options, providers=['CPUExecutionProvider']
+        )
+        self._input_names = input_names(self.session)
+
+    @staticmethod
+    def artifact_path(model_id: str, quantize: bool = False) -> Path:
+        """Get path of the cached ONNX artifact."""
+        name = model_id.replace('/', '--') + '-text'
+        if quantize:
+            name += '-int8'
+        return settings.encoder.onnx_dir / f'{name}.onnx'
+
+    @classmethod
+    def preload(cls, model_id: str,
+                quantize: bool = False) -> SharedModel:
+        """
+        Export model if needed and load its weights into arrays.
+
+        Initializers are left in the model as references to external data,
+        sessions get the arrays with `add_initializer` instead, which uses
+        them without copying. Model bytes themselves can't be shared:
+        onnxruntime Python API copies them into a temporary buffer.
+
+        Parameters:
+        - model_id (str): huggingface model id
+        - quantize (bool): use dynamically int8-quantized weights
+
+        Returns:
+        - SharedModel: model without weights and its weights
+        """
+        import onnx
+        from onnx import numpy_helper
+
+        path = cls.artifact_path(model_id, quantize)
+        if not path.exists():
+            export(model_id, quantize)
+        model = onnx.load(str(path))
+        weights = {}
+        for tensor in model.graph.initializer:
+            weights[tensor.name] = numpy_helper.to_array(tensor)
+            for field in ('raw_data', 'float_data', 'int32_data',
+                          'int64_data', 'double_data', 'uint64_data'):
+                tensor.ClearField(field)
+            tensor.data_location = onnx.TensorProto.EXTERNAL
+            entry = tensor.external_data.add()
+            entry.key, entry.value = 'location', 'preloaded'
+        return model.SerializeToString(), weights
+
+    def forward(self, input_ids: np.ndarray,
+                attention_mask: np.ndarray) -> np.ndarray:
+        feed = {
+            self._input_names[0]: input_ids,
+            self._input_names[1]: attention_mask,
+        }
+        return self.session.run(None, feed)[0]
+
+
+def input_names(session) -> tuple[str, str]:
+    """Get names of input ids and attention mask inputs of ONNX session."""
+    names = [i.name for i in session.get_inputs()]
+    return (
+        next(n for n in names if n.startswith('input_ids')),
+        next(n for n in names if n.startswith('attention_mask')),
+    )
+
+
+def export(model_id: str, quantize: bool = False):
+    """
+    Export CLIP text tower to ONNX and check its parity with TensorFlow.
+
+    Float32 model is always exported, int8 model is derived from it with
+    dynamic quantization. Artifacts are written to a temporary file first
+    and renamed only after parity check, so other processes never see
+    a broken model. Only one process at a time exports, the rest wait for
+    it and use its artifacts.
+
+    Parameters:
+    - model_id (str): huggingface model id
+    - quantize (bool): also produce int8-quantized model
+
+    Raises:
+    - RuntimeError: if exported model output differs from TensorFlow one
+        by more than the configured cosine similarity tolerance
+    """
+    settings.encoder.onnx_dir.mkdir(parents=True, exist_ok=True)
+    with open(settings.encoder.onnx_dir / '.export.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if ONNXBackend.artifact_path(model_id, quantize).exists():
+            return  # Exported by other process while waiting
+        _export(model_id, quantize)
+
+
+def _export(model_id: str, quantize: bool):
+    import tf2onnx
+    import onnxruntime as ort
+
+    tf_backend = TFBackend(model_id)
+    fp32_path = ONNXBackend.artifact_path(model_id)
+
+    # Map of temporary artifact paths to their final paths
+    paths = {}
+    fp32_source = fp32_path
+    if not fp32_path.exists():
+        logger.info('Exporting %s text tower to ONNX', model_id)
+        fp32_source = fp32_path.with_suffix(f'.{os.getpid()}.tmp')
+        tf2onnx.convert.from_function(
+            tf_backend.text_features,
+            input_signature=tf_backend.input_signature,
+            opset=15,
+            output_path=str(fp32_source),
+        )
+        paths[fp32_source] = fp32_path
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        logger.info('Quantizing %s text tower to int8', model_id)
+        int8_path = ONNXBackend.artifact_path(model_id, quantize=True)
+        tmp_path = int8_path.with_suffix(f'.{os.getpid()}.tmp')
+        quantize_dynamic(fp32_source, tmp_path, weight_type=QuantType.QInt8)
+        paths[tmp_path] = int8_path
+
+    # Compare exported models with TensorFlow, drop them if they diverge
+    input_ids, attention_mask = tf_backend.tokenizer(PARITY_TEXTS)
+    expected = tf_backend.forward(input_ids, attention_mask)
+    for tmp_path, path in paths.items():
+        session = ort.InferenceSession(
+            str(tmp_path), providers=['CPUExecutionProvider']
+        )
+        feed = dict(zip(input_names(session), (input_ids, attention_mask)))
+        actual = session.run(None, feed)[0]
+        similarity = cosine_similarity(expected, actual).min()
+        logger.info('ONNX parity for %s: min cosine %.5f', path, similarity)
+        tolerance = settings.encoder.onnx_parity_tolerance
+        if path != fp32_path:
+            tolerance = settings.encoder.onnx_int8_parity_tolerance
+        if similarity < tolerance:
+            for artifact in paths:
+                artifact.unlink(missing_ok=True)
+            raise RuntimeError(
+                f'Exported model {path.name} diverges from TensorFlow: '
+                f'min cosine similarity {similarity:.5f} is below {tolerance}'
+            )
+
+    for tmp_path, path in paths.items():
+        tmp_path.rename(path)
+
+
+def needs_export(name: str, model_id: str) -> bool:
+    """Check if backend model has to be exported from TensorFlow first."""
+    if name not in ('onnx', 'onnx-int8'):
+        return False
+    quantize = name == 'onnx-int8'
+    return not ONNXBackend.artifact_path(model_id, quantize).exists()
+
+
+def preload(name: str, model_id: str) -> Optional[SharedModel]:
+    """
+    Prepare backend weights, which can be shared by forked processes.
+
+    Parameters:
+    - name (str): backend name, one of 'tf', 'onnx', 'onnx-int8'
+    - model_id (str): huggingface model id
+
+    Returns:
+    - Optional[SharedModel]: model to pass to `create`, None if backend
+        doesn't support sharing weights between processes
+    """
+    if name == 'onnx':
+        return ONNXBackend.preload(model_id)
+    if name == 'onnx-int8':
+        return ONNXBackend.preload(model_id, quantize=True)
+    return None
+
+
+def create(name: str, model_id: str,
+           shared_model: Optional[SharedModel] = None) -> Backend:
+    """
+    Create inference backend.
+
+    Parameters:
+    - name (str): backend name, one of 'tf', 'onnx', 'onnx-int8'
+    - model_id (str): huggingface model id
+    - shared_model (SharedModel): model returned by `preload`, if any
+
+    Returns:
+    - Backend: inference backend
+    """
+    if name == 'tf':
+        return TFBackend(model_id)
+    if name == 'onnx':
+        return ONNXBackend(model_id, shared_model=shared_model)
+    if name == 'onnx-int8':
+        return ONNXBackend(model_id, quantize=True, shared_model=shared_model)
+    raise ValueError(f'Unknown encoder backend {name}')
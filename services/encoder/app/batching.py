@@ -0,0 +1,218 @@
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty, Full
+from typing import Callable, Optional
+
+import numpy as np
+
+from app import metrics
+
+
+class Overloaded(Exception):
+    """Raised when request queue is full and request can't be accepted."""
+
+
+class MicroBatcher:
+    """
+    Dedicated inference executor, which groups concurrent encoding requests
+    into batches.
+
+    Texts submitted by different request handlers are put into a bounded
+    queue. Worker threads accumulate them for up to `max_wait_ms`
+    milliseconds or until `max_batch_size` texts are collected. Then the
+    whole batch is encoded with a single `encode_fn` call and rows of the
+    resulting matrix are handed back to the callers through futures.
+
+    Number of worker threads limits how many forward passes run at once,
+    so inference doesn't fight over CPU with itself. When the queue is full,
+    new requests are rejected with `Overloaded` instead of waiting.
+
+    Attributes:
+    - encode_fn (Callable): function encoding list of texts into a matrix
+        of shape (len(texts), dim)
+    - max_batch_size (int): maximum number of texts in one batch
+    - max_wait_ms (float): maximum time to wait for a batch to fill up
+    - max_queue_size (int): maximum number of requests waiting in queue
+    - max_concurrency (int): number of batches encoded simultaneously
+
+    Usage:
+    ```python
+    batcher = MicroBatcher(encode_texts, max_batch_size=32, max_wait_ms=5)
+    batcher.start()
+    embeddings = batcher.encode(['red car', 'man with backpack'])
+    batcher.stop()
+    ```
+    """
+
+    def __init__(self, encode_fn: Callable[[list[str]], np.ndarray],
+                 max_batch_size: int = 32, max_wait_ms: float = 5,
+                 max_queue_size: int = 256, max_concurrency: int = 1):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue_size = max_queue_size
+        self.max_concurrency = max_concurrency
+        self._queue: Queue[tuple[list[str], Future, float]] = Queue(
+            maxsize=max_queue_size
+        )
+        self._pending: Optional[tuple[list[str], Future, float]] = None
+        self._collect_lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+        self._stopped = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'rejected': 0,
+            'batches': 0,
+            'texts': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+
+    def start(self):
+        """Start worker threads."""
+        self._stopped.clear()
+        for i in range(self.max_concurrency):
+            thread = threading.Thread(
+                target=self._run, name=f'micro-batcher-{i}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop worker threads, pending requests are still served."""
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of requests waiting to be encoded."""
+        return self._queue.qsize() + (self._pending is not None)
+
+    def stats(self) -> dict:
+        """Get queue depth and queue wait time statistics."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        served = stats['requests'] - stats['rejected']
+        stats['wait_seconds_avg'] = \
+            stats['wait_seconds_total'] / served if served else 0.0
+        stats['queue_depth'] = self.queue_depth
+        stats['max_queue_size'] = self.max_queue_size
+        return stats
+
+    def submit(self, texts: list[str]) -> list[Future]:
+        """
+        Submit texts for encoding.
+        Texts are split into chunks of at most `max_batch_size` texts,
+        either all of the chunks are queued or none of them.
+
+        Parameters:
+        - texts (list[str]): texts to encode
+
+        Returns:
+        - list[Future]: futures resolving to matrices of chunk embeddings
+
+        Raises:
+        - Overloaded: if there is not enough room in the queue
+        """
+        chunks = [
+            texts[i:i + self.max_batch_size]
+            for i in range(0, len(texts), self.max_batch_size)
+        ]
+        with self._submit_lock:
+            with self._stats_lock:
+                self._stats['requests'] += 1
+            free = self.max_queue_size - self._queue.qsize()
+            if len(chunks) > free:
+                with self._stats_lock:
+                    self._stats['rejected'] += 1
+                metrics.REJECTED.inc()
+                raise Overloaded()
+            futures = []
+            for chunk in chunks:
+                future = Future()
+                try:
+                    self._queue.put_nowait((chunk, future, time.monotonic()))
+                except Full:
+                    raise Overloaded()
+                futures.append(future)
+        metrics.QUEUE_DEPTH.set(self.queue_depth)
+        return futures
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        """
+        Encode texts, blocking until they are encoded.
+
+        Parameters:
+        - texts (list[str]): texts to encode
+
+        Returns:
+        - np.ndarray: matrix of shape (len(texts), dim)
+        """
+        futures = self.submit(texts)
+        return np.concatenate([future.result() for future in futures])
+
+    def _collect(self) -> list[tuple[list[str], Future, float]]:
+        """Block until first request arrives, then fill batch until timeout."""
+        if self._pending is not None:
+            batch, self._pending = [self._pending], None
+        else:
+            batch = [self._queue.get(timeout=0.1)]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                break
+            if size + len(item[0]) > self.max_batch_size:
+                # Doesn't fit, serve it first in the next batch
+                self._pending = item
+                break
+            batch.append(item)
+            size += len(item[0])
+        metrics.QUEUE_DEPTH.set(self.queue_depth)
+        return batch
+
+    def _record(self, batch: list[tuple[list[str], Future, float]]):
+        """Update queue wait statistics for a collected batch."""
+        now = time.monotonic()
+        waits = [now - enqueued_at for _, _, enqueued_at in batch]
+        for wait in waits:
+            metrics.QUEUE_WAIT.observe(wait)
+        metrics.BATCH_SIZE.observe(sum(len(item) for item, _, _ in batch))
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['texts'] += sum(len(item) for item, _, _ in batch)
+            self._stats['wait_seconds_total'] += sum(waits)
+            self._stats['wait_seconds_max'] = max(
+                self._stats['wait_seconds_max'], *waits
+            )
+
+    def _run(self):
+        """Worker loop: collect batch, encode it and fan out results."""
+        while not (self._stopped.is_set() and self.queue_depth == 0):
+            try:
+                with self._collect_lock:
+                    batch = self._collect()
+            except Empty:
+                continue
+            self._record(batch)
+            texts = [text for item, _, _ in batch for text in item]
+            try:
+                embeddings = self.encode_fn(texts)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for item, future, _ in batch:
+                future.set_result(embeddings[offset:offset + len(item)])
+                offset += len(item)
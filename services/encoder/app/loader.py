@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from common.config import settings
+from app import backends, metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def warmup_texts(length: int, batch_size: int) -> list[str]:
+    """
+    Generate texts which tokenize into exactly `length` tokens.
+
+    Every word is a single token, two more tokens are start and end ones.
+
+    Parameters:
+    - length (int): number of tokens, including special ones
+    - batch_size (int): number of texts
+
+    Returns:
+    - list[str]: texts
+    """
+    text = ' '.join(['a'] * max(length - 2, 1))
+    return [text] * batch_size
+
+
+class ModelLoader:
+    """
+    Loads inference backend in background and keeps service readiness state.
+
+    Service starts listening right away, while the model is being loaded
+    and warmed up in a separate thread. Until that is done, `ready` is
+    not set and encoding requests are rejected.
+
+    Attributes:
+    - backend: loaded inference backend, None until loading is done
+    - error (str): loading error message, if loading failed
+    - started_at (float): monotonic time the process started loading
+    - load_seconds (float): time spent on loading the model
+    - warmup_seconds (float): time spent on warmup
+    - first_query_seconds (float): time from the start of the process
+        to the end of the first successfully served query
+    - shared_model (SharedModel): preloaded model shared with forked
+        workers
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.shared_model: Optional[backends.SharedModel] = None
+        self.error: Optional[str] = None
+        self.started_at = time.monotonic()
+        self.load_seconds: Optional[float] = None
+        self.warmup_seconds: Optional[float] = None
+        self.first_query_seconds: Optional[float] = None
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    @property
+    def alive(self) -> bool:
+        return self.error is None
+
+    def start(self):
+        """Start loading model in background thread."""
+        self._thread = threading.Thread(
+            target=self._load, name='model-loader', daemon=True
+        )
+        self._thread.start()
+
+    def preload(self):
+        """
+        Load backend weights in the current process, before workers are
+        forked from it. Backend itself is still created by each worker.
+        """
+        start = time.monotonic()
+        self.shared_model = backends.preload(
+            settings.encoder.backend, settings.encoder.model
+        )
+        logger.info('Model preloaded in %.2fs', time.monotonic() - start)
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        """Encode texts with loaded backend."""
+        if not self.ready:
+            raise RuntimeError('Model is not loaded yet')
+        return self.backend.encode(texts)
+
+    def report_query(self):
+        """Record time to the first successfully served query."""
+        if self.first_query_seconds is None:
+            self.first_query_seconds = time.monotonic() - self.started_at
+            metrics.FIRST_QUERY_SECONDS.set(self.first_query_seconds)
+            logger.info(
+                'First query served %.2fs after start',
+                self.first_query_seconds
+            )
+
+    def status(self) -> dict:
+        """Get loading status and cold start timings."""
+        return {
+            'ready': self.ready,
+            'error': self.error,
+            'backend': settings.encoder.backend,
+            'model': settings.encoder.model,
+            'load_seconds': self.load_seconds,
+            'warmup_seconds': self.warmup_seconds,
+            'first_query_seconds': self.first_query_seconds,
+        }
+
+    def warmup(self):
+        """
+        Run warmup batches, so first real queries don't pay for graph
+        tracing and memory allocation.
+        """
+        for length in settings.encoder.warmup_lengths:
+            for batch_size in settings.encoder.warmup_batch_sizes:
+                self.backend.encode(warmup_texts(length, batch_size))
+
+    def _load(self):
+        try:
+            start = time.monotonic()
+            self.backend = backends.create(
+                settings.encoder.backend,
+                settings.encoder.model,
+                self.shared_model,
+            )
+            self.load_seconds = time.monotonic() - start
+            metrics.MODEL_LOAD_SECONDS.set(self.load_seconds)
+
+            start = time.monotonic()
+            self.warmup()
+            self.warmup_seconds = time.monotonic() - start
+            metrics.WARMUP_SECONDS.set(self.warmup_seconds)
+        except Exception as e:
+            logger.exception('Failed to load model')
+            self.error = str(e)
+            return
+        logger.info(
+            'Model loaded in %.2fs, warmed up in %.2fs',
+            self.load_seconds, self.warmup_seconds
+        )
+        self._ready.set()
@@ -1,13 +1,33 @@
-from fastapi import FastAPI, Response
-from fastapi.responses import RedirectResponse
-from transformers import TFCLIPModel, CLIPTokenizer
+import asyncio
+import os
+import time
+from typing import Literal, Optional
+
+import numpy as np
+from fastapi import FastAPI, Request, Response, Body, Header, HTTPException
+from fastapi.responses import RedirectResponse, JSONResponse
+from prometheus_client import (
+    generate_latest,
+    CollectorRegistry,
+    CONTENT_TYPE_LATEST,
+)
+from prometheus_client.multiprocess import MultiProcessCollector
 
 from common.config import settings
+from app import metrics, prompts
+from app.batching import MicroBatcher, Overloaded
+from app.serialization import EmbeddingFormat, parse_accept, pack
+from app.loader import ModelLoader
 
 
-model_id = settings.encoder.model
-model = TFCLIPModel.from_pretrained(model_id)
-tokenizer = CLIPTokenizer.from_pretrained(model_id)
+loader = ModelLoader()
+batcher = MicroBatcher(
+    loader.encode,
+    max_batch_size=settings.encoder.batch_max_size,
+    max_wait_ms=settings.encoder.batch_max_wait_ms,
+    max_queue_size=settings.encoder.queue_max_size,
+    max_concurrency=settings.encoder.max_concurrency,
+)
 
 
 description = """
@@ -15,6 +35,9 @@ Small serrvice to encode search entries into embeddings, using CLIP.
 """
 
 
+INSTRUMENTED_ENDPOINTS = {'/encode', '/encode/batch'}
+
+
 app = FastAPI(
     title='SVR Search Engine Text Encoder',
     description=description,
@@ -26,32 +49,228 @@ app = FastAPI(
 )
 
 
+@app.on_event('startup')
+def startup():
+    loader.start()
+    batcher.start()
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        metrics.start_worker_metrics()
+
+
+@app.on_event('shutdown')
+def shutdown():
+    batcher.stop()
+
+
+@app.middleware('http')
+async def track_requests(request: Request, call_next):
+    """Count requests and measure their latency."""
+    endpoint = request.url.path
+    if endpoint not in INSTRUMENTED_ENDPOINTS:
+        return await call_next(request)
+    start = time.perf_counter()
+    response = await call_next(request)
+    metrics.REQUEST_LATENCY.labels(endpoint).observe(
+        time.perf_counter() - start
+    )
+    metrics.REQUESTS.labels(endpoint, response.status_code).inc()
+    return response
+
+
+def negotiate(dtype: Optional[str], normalize: Optional[bool],
+              accept: Optional[str], ensemble: bool) -> EmbeddingFormat:
+    """
+    Pick embedding wire format.
+    Query parameters take precedence over Accept header, defaults are
+    unnormalized float32 vectors. Prompt ensemble vectors are always
+    normalized.
+    """
+    fmt = parse_accept(accept) or EmbeddingFormat()
+    if dtype is not None:
+        fmt.dtype = dtype
+    if normalize is not None:
+        fmt.normalize = normalize
+    fmt.normalize = fmt.normalize or ensemble
+    return fmt
+
+
+def ensure_ready():
+    """Raise 503 error if model is not loaded yet."""
+    if not loader.ready:
+        raise HTTPException(
+            status_code=503,
+            detail='Model is loading',
+            headers={'Retry-After': '5'},
+        )
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        {'detail': 'Encoder is overloaded, try again later'},
+        status_code=503,
+        headers={'Retry-After': str(settings.encoder.retry_after_seconds)},
+    )
+
+
+async def encode_texts(texts: list[str],
+                       ensemble: bool = False) -> np.ndarray:
+    """
+    Encode texts on the inference executor without blocking event loop.
+
+    With `ensemble` every text is expanded into configured prompt templates,
+    all prompts are encoded in the same request and their embeddings are
+    averaged into one normalized vector per text.
+
+    Raises:
+    - Overloaded: if inference queue is full
+    """
+    if ensemble:
+        texts = prompts.expand(texts)
+    futures = batcher.submit(texts)
+    results = await asyncio.gather(*map(asyncio.wrap_future, futures))
+    loader.report_query()
+    embeddings = np.concatenate(results)
+    if ensemble:
+        embeddings = prompts.reduce(embeddings)
+    return embeddings
+
+
 @app.get('/', include_in_schema=False)
 def root():
     """Root endpoint, redirects to docs"""
     return RedirectResponse(url='/docs')
 
 
+@app.get('/healthz', summary='Liveness probe')
+def healthz():
+    """
+    Liveness probe, fails only if model loading failed.
+    """
+    status_code = 200 if loader.alive else 500
+    return JSONResponse(loader.status(), status_code=status_code)
+
+
+@app.get('/readyz', summary='Readiness probe')
+def readyz():
+    """
+    Readiness probe, succeeds when model is loaded and warmed up.
+    Also reports cold start timings.
+    """
+    status_code = 200 if loader.ready else 503
+    return JSONResponse(loader.status(), status_code=status_code)
+
+
+@app.get('/stats', summary='Inference queue statistics')
+def stats():
+    """
+    Inference queue depth, wait time and batching statistics.
+    Also time spent on tokenization and forward pass, once model is loaded.
+    """
+    stats = batcher.stats()
+    if loader.ready:
+        stats['stages'] = loader.backend.stats()
+    return stats
+
+
+@app.get('/metrics', summary='Prometheus metrics')
+def prometheus_metrics():
+    """
+    Metrics in Prometheus text format: request counts and latencies,
+    batch sizes, queue wait, per-stage latencies, model load time and
+    process resource usage, per worker with several workers.
+    """
+    registry = None
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        metrics.update_worker_metrics()
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    content = generate_latest(registry) if registry else generate_latest()
+    return Response(content, media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get(
     '/encode',
     summary='Encode text into an embedding vector',
     response_description='Encoded text',
     response_class=Response,
 )
-def encode(text: str):
+async def encode(
+    text: str,
+    dtype: Optional[Literal['float32', 'float16', 'int8']] = None,
+    normalize: Optional[bool] = None,
+    ensemble: Optional[bool] = None,
+    accept: Optional[str] = Header(None),
+):
     """
     Encode text into an embedding vector.
+    Concurrent requests are encoded together in micro-batches.
+
+    Wire format is selected with `dtype` and `normalize` parameters or with
+    `Accept: application/x-embedding; dtype=float16; normalize=true` header
+    and described by `X-Embedding-*` response headers.
 
     Parameters:
     - text (str): text to encode
+    - dtype (str): element type: float32 (default), float16 or int8
+    - normalize (bool): L2-normalize vector, false by default
+    - ensemble (bool): average embeddings of the text formatted with
+        configured prompt templates, `prompt_ensemble` setting by default
 
     Returns:
     - bytes: encoded text
     """
-    inputs = tokenizer(text, return_tensors="tf")
-    text_embeddings = model.get_text_features(**inputs)
-    encoded = text_embeddings[0].numpy().astype('float32').tobytes()
+    ensure_ready()
+    if ensemble is None:
+        ensemble = settings.encoder.prompt_ensemble
+    fmt = negotiate(dtype, normalize, accept, ensemble)
+    embeddings = await encode_texts([text], ensemble)
+    content, headers = pack(embeddings, fmt)
+    return Response(
+        content=content,
+        media_type='application/octet-stream',
+        headers=headers,
+    )
+
+
+@app.post(
+    '/encode/batch',
+    summary='Encode list of texts into a matrix of embedding vectors',
+    response_description='Encoded texts',
+    response_class=Response,
+)
+async def encode_batch(
+    texts: list[str] = Body(...),
+    dtype: Optional[Literal['float32', 'float16', 'int8']] = None,
+    normalize: Optional[bool] = None,
+    ensemble: Optional[bool] = None,
+    accept: Optional[str] = Header(None),
+):
+    """
+    Encode list of texts into a packed matrix.
+    Rows are stored in the same order as texts, in C order.
+    Wire format is selected the same way as for `/encode`.
+
+    Parameters:
+    - texts (list[str]): texts to encode
+    - dtype (str): element type: float32 (default), float16 or int8
+    - normalize (bool): L2-normalize vectors, false by default
+    - ensemble (bool): average embeddings of each text formatted with
+        configured prompt templates, `prompt_ensemble` setting by default
+
+    Returns:
+    - bytes: encoded texts, matrix of shape (len(texts), dim)
+    """
+    ensure_ready()
+    if not texts:
+        raise HTTPException(status_code=422, detail='No texts to encode')
+    if ensemble is None:
+        ensemble = settings.encoder.prompt_ensemble
+    fmt = negotiate(dtype, normalize, accept, ensemble)
+    embeddings = await encode_texts(texts, ensemble)
+    content, headers = pack(embeddings, fmt)
     return Response(
-        content=encoded,
-        media_type='application/octet-stream'
+        content=content,
+        media_type='application/octet-stream',
+        headers=headers,
     )
@@ -0,0 +1,114 @@
+import resource
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+
+# Process metrics (resident memory, CPU time, open fds) are exported by
+# default process collector of prometheus_client. With several workers
+# metrics are collected from all of them through PROMETHEUS_MULTIPROC_DIR,
+# where process collector doesn't work, so every worker reports its resource
+# usage with WORKER_* gauges instead.
+
+# How often workers update their resource usage gauges, seconds
+WORKER_METRICS_INTERVAL = 5
+
+REQUESTS = Counter(
+    'encoder_requests_total',
+    'Number of HTTP requests',
+    ['endpoint', 'status'],
+)
+REQUEST_LATENCY = Histogram(
+    'encoder_request_seconds',
+    'HTTP request latency',
+    ['endpoint'],
+)
+STAGE_LATENCY = Histogram(
+    'encoder_stage_seconds',
+    'Latency of request processing stages',
+    ['stage'],
+    buckets=(
+        .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5,
+    ),
+)
+BATCH_SIZE = Histogram(
+    'encoder_batch_size',
+    'Number of texts encoded in one forward pass',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+QUEUE_WAIT = Histogram(
+    'encoder_queue_wait_seconds',
+    'Time requests spend in inference queue before their batch starts',
+    buckets=(
+        .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5,
+    ),
+)
+QUEUE_DEPTH = Gauge(
+    'encoder_queue_depth',
+    'Number of requests waiting in inference queue',
+    multiprocess_mode='livesum',
+)
+REJECTED = Counter(
+    'encoder_rejected_total',
+    'Number of requests rejected because inference queue was full',
+)
+MODEL_LOAD_SECONDS = Gauge(
+    'encoder_model_load_seconds',
+    'Time spent on loading the model',
+    multiprocess_mode='max',
+)
+WARMUP_SECONDS = Gauge(
+    'encoder_warmup_seconds',
+    'Time spent on model warmup',
+    multiprocess_mode='max',
+)
+FIRST_QUERY_SECONDS = Gauge(
+    'encoder_first_query_seconds',
+    'Time from the process start to the first served query',
+    multiprocess_mode='max',
+)
+WORKER_RESIDENT_MEMORY = Gauge(
+    'encoder_worker_resident_memory_bytes',
+    'Resident memory of a worker process, including shared pages',
+    multiprocess_mode='liveall',
+)
+WORKER_PROPORTIONAL_MEMORY = Gauge(
+    'encoder_worker_proportional_memory_bytes',
+    'Proportional set size of a worker process: shared pages are divided '
+    'between processes sharing them, so the sum is total memory',
+    multiprocess_mode='liveall',
+)
+WORKER_CPU_SECONDS = Gauge(
+    'encoder_worker_cpu_seconds',
+    'CPU time used by a worker process',
+    multiprocess_mode='liveall',
+)
+
+
+def update_worker_metrics():
+    """Record resource usage of the current process."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    WORKER_CPU_SECONDS.set(usage.ru_utime + usage.ru_stime)
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = dict(
+                line.split(':', 1) for line in f
+                if line.startswith(('Rss:', 'Pss:'))
+            )
+    except OSError:
+        return  # Not Linux or kernel older than 4.14
+    WORKER_RESIDENT_MEMORY.set(int(fields['Rss'].split()[0]) * 1024)
+    WORKER_PROPORTIONAL_MEMORY.set(int(fields['Pss'].split()[0]) * 1024)
+
+
+def start_worker_metrics():
+    """Keep updating resource usage gauges in a background thread."""
+    def update():
+        while True:
+            update_worker_metrics()
+            time.sleep(WORKER_METRICS_INTERVAL)
+
+    threading.Thread(
+        target=update, name='worker-metrics', daemon=True
+    ).start()
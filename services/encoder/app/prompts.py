@@ -0,0 +1,45 @@
+import numpy as np
+
+from common.config import settings
+
+
+def expand(texts: list[str]) -> list[str]:
+    """
+    Expand every text into a set of prompts using configured templates.
+
+    Parameters:
+    - texts (list[str]): texts to expand
+
+    Returns:
+    - list[str]: prompts, `len(prompt_templates)` consecutive prompts
+        for every text
+    """
+    return [
+        template.format(text)
+        for text in texts
+        for template in settings.encoder.prompt_templates
+    ]
+
+
+def reduce(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Average embeddings of prompts expanded from the same text.
+
+    Prompt embeddings are L2-normalized before averaging, so every template
+    contributes equally, and the average is normalized again.
+
+    Parameters:
+    - embeddings (np.ndarray): prompt embeddings in order produced by
+        `expand`, shape (len(texts) * len(prompt_templates), dim)
+
+    Returns:
+    - np.ndarray: normalized embeddings, shape (len(texts), dim)
+    """
+    n_templates = len(settings.encoder.prompt_templates)
+    embeddings = embeddings.reshape(-1, n_templates, embeddings.shape[-1])
+    embeddings = embeddings / np.linalg.norm(
+        embeddings, axis=-1, keepdims=True
+    )
+    embeddings = embeddings.mean(axis=1)
+    embeddings /= np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings.astype('float32')
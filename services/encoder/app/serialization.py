@@ -0,0 +1,90 @@
+import time
+from typing import Literal, Optional
+
+import numpy as np
+from pydantic import BaseModel, ValidationError
+
+from app import metrics
+
+
+MEDIA_TYPE = 'application/x-embedding'
+
+
+class EmbeddingFormat(BaseModel):
+    """
+    Wire format of embeddings.
+
+    Attributes:
+    - dtype (str): element type, 'int8' vectors are quantized symmetrically
+        with a per-row scale, reported in `X-Embedding-Scale` header
+    - normalize (bool): L2-normalize vectors before packing
+    """
+    dtype: Literal['float32', 'float16', 'int8'] = 'float32'
+    normalize: bool = False
+
+
+def parse_accept(accept: Optional[str]) -> Optional[EmbeddingFormat]:
+    """
+    Parse embedding format from Accept header, e.g.
+    `application/x-embedding; dtype=float16; normalize=true`.
+
+    Parameters:
+    - accept (str): Accept header value
+
+    Returns:
+    - Optional[EmbeddingFormat]: requested format, None if header doesn't
+        ask for specific embedding format or asks for invalid one
+    """
+    if not accept:
+        return None
+    for media_range in accept.split(','):
+        media_type, *params = media_range.split(';')
+        if media_type.strip() != MEDIA_TYPE:
+            continue
+        params = dict(
+            map(str.strip, param.split('=', 1))
+            for param in params if '=' in param
+        )
+        try:
+            return EmbeddingFormat(**params)
+        except ValidationError:
+            return None
+    return None
+
+
+def pack(embeddings: np.ndarray,
+         fmt: EmbeddingFormat) -> tuple[bytes, dict[str, str]]:
+    """
+    Pack matrix of embeddings into bytes.
+
+    Parameters:
+    - embeddings (np.ndarray): float32 matrix of shape (n, dim)
+    - fmt (EmbeddingFormat): wire format
+
+    Returns:
+    - bytes: packed rows in C order
+    - dict[str, str]: headers describing the format
+    """
+    start = time.perf_counter()
+    if fmt.normalize:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.maximum(norms, 1e-12)
+    headers = {
+        'X-Embedding-Count': str(embeddings.shape[0]),
+        'X-Embedding-Dim': str(embeddings.shape[1]),
+        'X-Embedding-Dtype': fmt.dtype,
+        'X-Embedding-Normalized': str(fmt.normalize).lower(),
+    }
+    if fmt.dtype == 'int8':
+        scales = np.abs(embeddings).max(axis=1, keepdims=True) / 127
+        scales = np.maximum(scales, 1e-12)
+        content = np.round(embeddings / scales).astype('int8').tobytes()
+        headers['X-Embedding-Scale'] = ','.join(
+            f'{scale:.9g}' for scale in scales[:, 0]
+        )
+    else:
+        content = embeddings.astype(fmt.dtype).tobytes()
+    metrics.STAGE_LATENCY.labels('serialize').observe(
+        time.perf_counter() - start
+    )
+    return content, headers
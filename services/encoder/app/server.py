@@ -0,0 +1,151 @@
+"""
+Encoder server entrypoint.
+
+With a single worker it's a plain uvicorn server. With several workers
+it's a pre-fork server: the parent process binds the socket, preloads model
+weights and forks workers, which accept connections from the shared socket.
+Weights loaded before forking are shared by workers copy-on-write, instead
+of being loaded by every worker. Dead workers are restarted by the parent.
+
+Model which isn't exported to ONNX yet isn't preloaded: export takes
+minutes, so workers are forked right away to answer probes, and their
+background loaders export the model, one of them at a time.
+
+Usage:
+```bash
+python -m app.server
+```
+"""
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+import uvicorn
+
+from common.config import settings
+
+
+logger = logging.getLogger('app.server')
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """Create listening socket shared by all workers."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve_worker(sock: socket.socket):
+    """Run uvicorn server in a forked worker."""
+    from app.main import app
+
+    config = uvicorn.Config(app, access_log=False)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+def spawn_worker(sock: socket.socket) -> int:
+    """Fork worker process and return its pid."""
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        exit_code = 0
+        try:
+            serve_worker(sock)
+        except BaseException:
+            logger.exception('Worker crashed')
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+    return pid
+
+
+def run_prefork(host: str, port: int, workers: int):
+    """
+    Preload model, fork workers and supervise them until termination.
+
+    Parameters:
+    - host (str): host to bind to
+    - port (int): port to bind to
+    - workers (int): number of worker processes
+    """
+    # Must be set before prometheus_client is imported
+    metrics_dir = tempfile.mkdtemp(prefix='encoder-metrics-')
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = metrics_dir
+
+    from prometheus_client import multiprocess
+    from app import backends
+    from app.main import loader
+
+    sock = bind_socket(host, port)
+    if settings.encoder.backend == 'tf':
+        logger.warning(
+            'TensorFlow is not fork-safe, each worker loads its own model'
+        )
+    elif not settings.encoder.share_weights:
+        logger.info('Weight sharing is disabled, each worker loads its model')
+    elif backends.needs_export(settings.encoder.backend,
+                               settings.encoder.model):
+        logger.warning(
+            'Model is not exported to ONNX yet, workers export it and load '
+            'their own copies of weights until restart'
+        )
+    else:
+        loader.preload()
+
+    pids = {spawn_worker(sock) for _ in range(workers)}
+    logger.info('Started %d workers: %s', workers, sorted(pids))
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while pids:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        pids.discard(pid)
+        multiprocess.mark_process_dead(pid)
+        if not stopping:
+            logger.warning(
+                'Worker %d exited with status %d, restarting', pid, status
+            )
+            time.sleep(1)
+            pids.add(spawn_worker(sock))
+
+    sock.close()
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    host, port = settings.encoder.host, settings.encoder.port
+    if settings.encoder.workers == 1:
+        uvicorn.run('app.main:app', host=host, port=port, access_log=False)
+    else:
+        run_prefork(host, port, settings.encoder.workers)
+
+
+if __name__ == '__main__':
+    main()
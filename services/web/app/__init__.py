@@ -1,5 +1,8 @@
 from typing import Optional
+import json
+import logging
 
+import click
 from flask import Flask
 from flask_login import LoginManager
 
@@ -49,4 +52,21 @@ def create_app():
     from app.blueprints.search import bp as search_bp
     app.register_blueprint(search_bp, url_prefix='/search')
 
+    @app.cli.command('reindex')
+    def reindex():
+        """Rebuild frame index with current parameters without downtime."""
+        from app.database import frame_search, vector_store
+        logging.basicConfig(level=logging.INFO)
+        store = frame_search.get_store()
+        if not isinstance(store, vector_store.RediSearchStore):
+            raise click.ClickException('Only RediSearch index can be rebuilt')
+        if not store.reindex(wait=True):
+            raise click.ClickException('Index rebuild is already running')
+
+    @app.cli.command('index-info')
+    def index_info():
+        """Print state of frame indexes of all source managers."""
+        from app.database import frame_search
+        click.echo(json.dumps(frame_search.get_store().info(), indent=2))
+
     return app
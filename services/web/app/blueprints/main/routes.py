@@ -8,7 +8,7 @@ from common.config import settings
 from app.blueprints.main import bp
 from app.security import secrets, auth
 from app import logic
-from app.database import models
+from app.database import models, frame_search
 from app.clients import source_manager
 
 
@@ -171,6 +171,7 @@ def register():
         ),
     )
     db_user.save()
+    frame_search.register(sm_client_id)
 
     return redirect(url_for('main.login'))
 
@@ -186,6 +187,7 @@ def logout():
 @login_required
 @logic.action(endpoint='main.index')
 def unregister():
+    frame_search.unregister(current_user.db_user.source_manager.client_id)
     models.User.delete(current_user.db_user.pk)
     source_manager.unregister()
     logout_user()
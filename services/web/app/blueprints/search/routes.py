@@ -1,19 +1,20 @@
-from PIL import Image
-import io
-import base64
+from typing import Optional
 from datetime import datetime
 
-from flask import request, session
+from flask import (
+    request, session, jsonify, url_for, abort, make_response,
+    after_this_request,
+)
 from flask_login import login_required, current_user
+from pydantic import BaseModel, Field, ValidationError
 
-from common.utils.frontend import (
-    draw_bounding_box,
-    date_time_form_to_timestamp,
-)
+from common.config import settings
+from common.utils.frontend import date_time_form_to_timestamp
 from app.blueprints.search import bp
-from app import logic
+from app import logic, thumbnails
 from app.clients import encoder, source_manager
-from app.database.frame_search import find
+from app.database import frame_search
+from app.database.frame_search import find_many
 
 
 @bp.before_request
@@ -30,39 +31,54 @@ def index():
     date_end = request.args.get('date_end', '')
     time_start = request.args.get('time_start', '')
     time_end = request.args.get('time_end', '')
-    top_k = request.args.get('top_k', 5)
+    top_k = request.args.get('top_k', 5, type=int)
+    if not 1 <= top_k <= settings.web.search_page_max_size:
+        abort(400)
 
     time_start = date_time_form_to_timestamp(date_start, time_start)
     time_end = date_time_form_to_timestamp(date_end, time_end)
 
     results = []
+    next_url = None
     if search_entry:
-        # Encode text query to CLIP embedding
-        query_embedding = encoder.encode(search_entry)
-
-        # Search for frames with similar embeddings
-        # (approximate nearest neighbors search)
-        frames = find(
-            query_embedding=query_embedding,
-            top_k=top_k,
-            source_manager_id=current_user.db_user.source_manager.client_id,
-            time_start=time_start,
-            time_end=time_end,
-        )
-
-        # Get images for found frames from source manager, draw bounding boxes
-        images = []
-        for frame in frames:
-            image_data = source_manager.videos.get_frame(
-                frame.chunk_id,  frame.position
+        # Pages are served from the cursor, query is encoded and searched
+        # only for the first page or if the cursor has expired
+        source_manager_id = current_user.db_user.source_manager.client_id
+        cursor = request.args.get('cursor')
+        try:
+            frames, next_cursor = frame_search.find_page(
+                cursor, top_k, source_manager_id
+            )
+        except frame_search.CursorNotFound:
+            # Encode text query to CLIP embedding
+            query_embedding = encoder.encode(search_entry)
+            cursor = frame_search.open_cursor(
+                query_embedding=query_embedding,
+                source_manager_id=source_manager_id,
+                time_start=time_start,
+                time_end=time_end,
+                offset=frame_search.cursor_offset(cursor),
             )
-            image = Image.open(io.BytesIO(image_data))
-            draw_bounding_box(image, frame.box, (255, 0, 0), 3)
-            # Encode image to base64
-            encoded = io.BytesIO()
-            image.save(encoded, format='PNG')
-            encoded = base64.b64encode(encoded.getvalue()).decode('utf-8')
-            images.append(encoded)
+            # Search for frames with similar embeddings
+            # (approximate nearest neighbors search)
+            frames, next_cursor = frame_search.find_page(
+                cursor, top_k, source_manager_id
+            )
+        # Images of the page are requested by the browser one by one,
+        # fetch them with requests grouped by chunk once the page is sent
+        prefetch = thumbnails.prefetch(source_manager_id, [
+            (frame.chunk_id, frame.position, frame.box) for frame in frames
+        ])
+        if prefetch is not None:
+            @after_this_request
+            def prefetch_images(response):
+                response.call_on_close(prefetch)
+                return response
+
+        if next_cursor is not None:
+            args = request.args.to_dict()
+            args['cursor'] = next_cursor
+            next_url = url_for('search.index', **args)
 
         # Get source names, convert timestamps to human-readable format
         all_sources = source_manager.sources.get_all()
@@ -72,8 +88,130 @@ def index():
             dt = datetime.fromtimestamp(frame.timestamp)
             frame.timestamp = dt.strftime('%Y-%m-%d %H:%M:%S')
 
-        results = zip(frames, images)
+        results = frames
     session['search.index'] = {
         'search_entry': search_entry,
     }
-    return {'results': results}
+    return {
+        'results': results,
+        'next_url': next_url,
+        'max_top_k': settings.web.search_page_max_size,
+    }
+
+
+@bp.route('/frame/<int:chunk_id>/<int:position>', methods=['GET'])
+def frame(chunk_id: int, position: int):
+    """
+    Get image of a found frame with drawn bounding box.
+
+    Image of a frame never changes, so it's served with a strong ETag and
+    cached by the browser, revalidation doesn't touch the source manager.
+    Image which is being prefetched is answered with 503 and Retry-After,
+    so no worker waits for it.
+
+    Query parameters:
+    - box (str): bounding box coordinates, `x1,y1,x2,y2`
+
+    Returns:
+    - rendered image
+    """
+    try:
+        box = [int(x) for x in request.args.get('box', '').split(',')]
+    except ValueError:
+        abort(400)
+    if len(box) != 4:
+        abort(400)
+    source_manager_id = current_user.db_user.source_manager.client_id
+    etag = thumbnails.cache_key(source_manager_id, chunk_id, position, box)
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        try:
+            image = thumbnails.get(
+                source_manager_id, chunk_id, position, box
+            )
+        except thumbnails.Pending:
+            response = make_response('', 503)
+            response.retry_after = thumbnails.PREFETCH_RETRY_AFTER
+            response.cache_control.no_store = True
+            return response
+        if image is None:
+            abort(404)
+        response = make_response(image)
+        response.mimetype = thumbnails.mimetype()
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = settings.web.thumbnail_max_age
+    response.cache_control.immutable = True
+    return response
+
+
+class BatchSearch(BaseModel):
+    search_entries: list[str] = Field(..., min_items=1, max_items=32)
+    top_k: int = Field(5, ge=1, le=100)
+    time_start: Optional[float] = None
+    time_end: Optional[float] = None
+    debug: bool = False
+
+
+@bp.route('/batch', methods=['POST'])
+def batch():
+    """
+    Search frames for several search entries at once.
+
+    All entries are encoded with a single encoder request and searched
+    with a single Redis pipeline.
+
+    Body (JSON):
+    - search_entries (list[str]): search entries
+    - top_k (int): number of frames to find for each entry
+    - time_start (float): minimal frame timestamp, optional
+    - time_end (float): maximal frame timestamp, optional
+    - debug (bool): include query plan chosen by the vector store
+
+    Returns:
+    - JSON with found frames for each search entry, closest first
+    """
+    try:
+        query = BatchSearch.parse_obj(request.get_json(force=True))
+    except ValidationError as e:
+        return jsonify({'detail': e.errors()}), 422
+
+    filters = {
+        'source_manager_id': current_user.db_user.source_manager.client_id,
+        'time_start': query.time_start,
+        'time_end': query.time_end,
+    }
+    query_embeddings = encoder.encode_many(query.search_entries)
+    results = find_many(
+        query_embeddings=query_embeddings,
+        top_k=query.top_k,
+        **filters,
+    )
+    response = {
+        'results': [
+            {
+                'search_entry': search_entry,
+                'frames': [frame.dict() for frame in frames],
+            }
+            for search_entry, frames in zip(query.search_entries, results)
+        ]
+    }
+    if query.debug:
+        response['plan'] = frame_search.plan(top_k=query.top_k, **filters)
+    return jsonify(response)
+
+
+@bp.route('/stats', methods=['GET'])
+def stats():
+    """Search pipeline statistics: caches of the current worker and
+    vector store state, including index rebuild progress. Only the index
+    of the user's source manager is shown, see `flask index-info` for
+    all of them."""
+    source_manager_id = current_user.db_user.source_manager.client_id
+    return jsonify({
+        'encoder_cache': encoder.cache_info(),
+        'search_cache': frame_search.cache_info(),
+        'thumbnail_cache': thumbnails.cache_info(),
+        'vector_store': frame_search.get_store().info(source_manager_id),
+    })
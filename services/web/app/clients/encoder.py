@@ -1,9 +1,18 @@
-from typing import Callable
+from typing import Callable, Optional
 from urllib.error import HTTPError
+from collections import OrderedDict
+from hashlib import sha1
+import threading
+import time
+
+import numpy as np
+import requests
+from redis.exceptions import RedisError
 
 from common.config import settings
 from common.clients.http import ClientSession
 from common.utils.fastapi import get_error_msg
+from app.database import connection
 
 
 session = ClientSession(settings.encoder.url)
@@ -19,7 +28,253 @@ def middleware(call: Callable, url: str, **kwargs):
     return response
 
 
-def encode(text: str) -> bytes:
-    params = {'text': text}
+class LRUCache:
+    """
+    Bounded thread-safe LRU cache with per-entry TTL.
+
+    Attributes:
+    - max_size (int): maximum number of entries, least recently used entries
+        are evicted first
+    - ttl (float): entry time to live in seconds
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def query_format() -> dict:
+    """
+    Get embedding wire format of search queries.
+
+    Vectors are requested in full precision, the same as frame embeddings,
+    vector store converts them into index field type itself and uses them
+    as is to re-rank candidates. For inner product and cosine distance
+    vectors are requested L2-normalized, which keeps the ranking, but
+    makes scores comparable between queries.
+
+    Returns:
+    - dict: `dtype` and `normalize` query parameters
+    """
+    return {
+        'dtype': 'float32',
+        'normalize': settings.web.hnsw_distance_metric in ('IP', 'COSINE'),
+    }
+
+
+def decode(response: requests.Response) -> np.ndarray:
+    """
+    Decode embeddings from encoder response into float32 vectors.
+    Responses without format headers are treated as float32 vectors.
+
+    Parameters:
+    - response (requests.Response): encoder response
+
+    Returns:
+    - np.ndarray: matrix of embeddings, one row per encoded text
+    """
+    dtype = response.headers.get('X-Embedding-Dtype', 'float32')
+    dim = int(response.headers.get('X-Embedding-Dim', settings.web.hnsw_dim))
+    embeddings = np.frombuffer(response.content, dtype=dtype).reshape(-1, dim)
+    if dtype == 'int8':
+        scales = response.headers['X-Embedding-Scale'].split(',')
+        scales = np.array(scales, dtype='float32')[:, None]
+        embeddings = embeddings * scales
+    return embeddings.astype('float32')
+
+
+local_cache = LRUCache(
+    max_size=settings.encoder.cache_local_size,
+    ttl=settings.encoder.cache_local_ttl,
+)
+cache_stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0, 'errors': 0}
+
+
+def normalize(text: str) -> str:
+    """Normalize search entry, so trivially different entries share a key."""
+    return ' '.join(text.lower().split())
+
+
+def cache_key(text: str) -> str:
+    """
+    Get cache key for a search entry.
+    Key includes encoder model id, wire format and prompt templates, so
+    changing the model, the index field type or prompts invalidates it.
+
+    Parameters:
+    - text (str): search entry
+
+    Returns:
+    - str: cache key
+    """
+    fmt = query_format()
+    fmt = '{}:{}'.format(fmt['dtype'], int(fmt['normalize']))
+    if settings.encoder.prompt_ensemble:
+        templates = '\n'.join(settings.encoder.prompt_templates)
+        fmt += ':' + sha1(templates.encode()).hexdigest()[:8]
+    digest = sha1(normalize(text).encode()).hexdigest()
+    return f'encoder_cache:{settings.encoder.model}:{fmt}:{digest}'
+
+
+def cache_info() -> dict:
+    """
+    Get encoder cache statistics for the current worker.
+
+    Returns:
+    - dict: hit/miss counters, hit rate and current local cache size
+    """
+    info = dict(cache_stats)
+    hits = info['local_hits'] + info['redis_hits']
+    total = hits + info['misses']
+    info['hit_rate'] = hits / total if total else 0.0
+    info['local_size'] = len(local_cache)
+    return info
+
+
+def _encode(text: str) -> bytes:
+    params = {
+        'text': text,
+        'ensemble': settings.encoder.prompt_ensemble,
+        **query_format(),
+    }
     response = session.request('GET', '/encode', params=params)
-    return response.content
+    return decode(response)[0].tobytes()
+
+
+def _encode_many(texts: list[str]) -> list[bytes]:
+    params = {
+        'ensemble': settings.encoder.prompt_ensemble,
+        **query_format(),
+    }
+    response = session.request(
+        'POST', '/encode/batch', params=params, json=texts
+    )
+    return [row.tobytes() for row in decode(response)]
+
+
+def encode(text: str) -> bytes:
+    """
+    Encode text into an embedding vector.
+
+    Embeddings are looked up in the per-worker LRU cache first, then in
+    the Redis cache shared by all workers. Only on a miss in both of them
+    the text encoder is called. Redis failures are treated as misses.
+
+    Parameters:
+    - text (str): text to encode
+
+    Returns:
+    - bytes: float32 embedding vector
+    """
+    if not settings.encoder.cache_enabled:
+        return _encode(text)
+
+    key = cache_key(text)
+    embedding = local_cache.get(key)
+    if embedding is not None:
+        cache_stats['local_hits'] += 1
+        return embedding
+
+    try:
+        embedding = connection.get(key)
+    except RedisError:
+        cache_stats['errors'] += 1
+    if embedding is not None:
+        cache_stats['redis_hits'] += 1
+        local_cache.set(key, embedding)
+        return embedding
+
+    cache_stats['misses'] += 1
+    embedding = _encode(normalize(text))
+    local_cache.set(key, embedding)
+    try:
+        connection.set(key, embedding, ex=settings.encoder.cache_redis_ttl)
+    except RedisError:
+        cache_stats['errors'] += 1
+    return embedding
+
+
+def encode_many(texts: list[str]) -> list[bytes]:
+    """
+    Encode several texts into embedding vectors.
+
+    Cache lookups are the same as in `encode`, but Redis cache is queried
+    with a single MGET and all texts missing in both caches are encoded
+    with a single batch request.
+
+    Parameters:
+    - texts (list[str]): texts to encode
+
+    Returns:
+    - list[bytes]: float32 embedding vectors
+    """
+    if not texts:
+        return []
+    if not settings.encoder.cache_enabled:
+        return _encode_many(texts)
+
+    keys = [cache_key(text) for text in texts]
+    embeddings = [local_cache.get(key) for key in keys]
+    cache_stats['local_hits'] += sum(e is not None for e in embeddings)
+
+    missing = [i for i, e in enumerate(embeddings) if e is None]
+    if missing:
+        try:
+            cached = connection.mget([keys[i] for i in missing])
+        except RedisError:
+            cache_stats['errors'] += 1
+            cached = [None] * len(missing)
+        for i, embedding in zip(missing, cached):
+            if embedding is not None:
+                cache_stats['redis_hits'] += 1
+                local_cache.set(keys[i], embedding)
+                embeddings[i] = embedding
+
+    # Same text may be repeated, encode it only once
+    missing = {keys[i]: i for i, e in enumerate(embeddings) if e is None}
+    if missing:
+        cache_stats['misses'] += len(missing)
+        encoded = _encode_many([
+            normalize(texts[i]) for i in missing.values()
+        ])
+        encoded = dict(zip(missing, encoded))
+        try:
+            pipe = connection.pipeline(transaction=False)
+            for key, embedding in encoded.items():
+                pipe.set(key, embedding, ex=settings.encoder.cache_redis_ttl)
+            pipe.execute()
+        except RedisError:
+            cache_stats['errors'] += 1
+        for i, key in enumerate(keys):
+            if embeddings[i] is None:
+                embeddings[i] = encoded[key]
+                local_cache.set(key, encoded[key])
+    return embeddings
@@ -1,12 +1,251 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Optional
+from urllib.error import HTTPError
+import logging
+import math
+import struct
+import threading
+import time
+
+import requests
+
+from common.config import settings
 from app.clients.source_manager import session
 
 
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+# Source managers without multi-frame route: base url -> time (monotonic)
+# until which frames are requested one by one
+_single_frame_only: dict[str, float] = {}
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """
+    Get thread pool for frame requests.
+    Pool is created on first use, so its threads are started in the worker
+    process, not in the uwsgi master before fork.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.web.frame_fetch_concurrency,
+                    thread_name_prefix='frame-fetch',
+                )
+    return _executor
+
+
 def get_last_frame(source_id: int) -> bytes:
     url = 'videos/get/frame/last'
     params = {'source_id': source_id}
     return session.request('GET', url, params=params).content
 
 
-def get_frame(chunk_id: int, frame_id: int) -> bytes:
+def get_frame(chunk_id: int, frame_id: int,
+              timeout: Optional[float] = None) -> bytes:
     url = f'videos/get/frame/{chunk_id}/{frame_id}'
-    return session.request('GET', url).content
+    if timeout is None:
+        return session.request('GET', url).content
+    return session.request('GET', url, timeout=timeout).content
+
+
+def _get_frame_safe(chunk_id: int, frame_id: int) -> Optional[bytes]:
+    try:
+        return get_frame(
+            chunk_id, frame_id, timeout=settings.web.frame_fetch_timeout
+        )
+    except (HTTPError, requests.exceptions.RequestException) as e:
+        logger.warning('Failed to get frame %d of chunk %d: %s',
+                       frame_id, chunk_id, e)
+        return None
+
+
+def get_chunk_frames(chunk_id: int, frame_ids: list[int],
+                     timeout: Optional[float] = None) -> list[bytes]:
+    """
+    Get several frames of a video chunk with a single request, so the
+    chunk is decoded only once.
+
+    Response is a length-prefixed binary stream: for every requested
+    frame, in the same order, 4-byte big-endian length followed by the
+    encoded frame. Zero length means the frame is missing.
+
+    Parameters:
+    - chunk_id (int): id of the video chunk
+    - frame_ids (list[int]): frame positions in the chunk
+    - timeout (float): request timeout, session timeout if not set
+
+    Returns:
+    - list[bytes]: encoded frames, empty for missing frames
+
+    Raises:
+    - ValueError: if response is malformed
+    """
+    url = f'videos/get/frames/{chunk_id}'
+    kwargs = {'params': {'frame_ids': frame_ids}}
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+    content = session.request('GET', url, **kwargs).content
+    frames, offset = [], 0
+    while offset < len(content):
+        if offset + 4 > len(content):
+            raise ValueError('Truncated frame length')
+        size, = struct.unpack_from('>I', content, offset)
+        offset += 4
+        if offset + size > len(content):
+            raise ValueError('Truncated frame')
+        frames.append(content[offset:offset + size])
+        offset += size
+    if len(frames) != len(frame_ids):
+        raise ValueError(
+            f'Expected {len(frame_ids)} frames, got {len(frames)}'
+        )
+    return frames
+
+
+def _route_missing(e: HTTPError) -> bool:
+    """
+    Check if multi-frame request failed because source manager doesn't
+    have the route, rather than because of the chunk or frames.
+    Unknown route gets 404 with the generic `Not Found` detail, missing
+    chunk is reported with its own detail.
+    """
+    if e.code in (405, 501):
+        return True
+    return e.code == 404 and '`Not Found`' in str(e.msg)
+
+
+def _single_frame_only_now() -> bool:
+    """Check if current source manager is known to lack multi-frame route."""
+    until = _single_frame_only.get(session.base_url)
+    if until is None:
+        return False
+    if time.monotonic() < until:
+        return True
+    _single_frame_only.pop(session.base_url, None)
+    return False
+
+
+def _get_chunk_frames_safe(
+    chunk_id: int,
+    frame_ids: list[int],
+) -> Optional[list[Optional[bytes]]]:
+    """Get frames of a chunk, None if they must be requested one by one."""
+    base_url = session.base_url
+    try:
+        frames = get_chunk_frames(
+            chunk_id, frame_ids, timeout=settings.web.frame_fetch_timeout
+        )
+    except HTTPError as e:
+        if _route_missing(e):
+            # Checked again later, source manager may be updated
+            _single_frame_only[base_url] = \
+                time.monotonic() + settings.web.frame_multi_route_ttl
+        else:
+            logger.warning('Failed to get frames of chunk %d: %s',
+                           chunk_id, e)
+        return None
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning('Failed to get frames of chunk %d: %s', chunk_id, e)
+        return None
+    return [frame or None for frame in frames]
+
+
+def _wait(futures: list[Future], labels: list[str]) -> list:
+    """
+    Wait for frame requests, bounded by timeout per round of concurrent
+    requests. Results of requests which didn't finish in time are None.
+    """
+    rounds = math.ceil(len(futures) / settings.web.frame_fetch_concurrency)
+    wait(futures, timeout=settings.web.frame_fetch_timeout * rounds)
+    results = []
+    for future, label in zip(futures, labels):
+        if future.done():
+            results.append(future.result())
+        else:
+            future.cancel()
+            logger.warning('Timed out getting %s', label)
+            results.append(None)
+    return results
+
+
+def _get_frames_single(
+    frames: list[tuple[int, int]],
+) -> list[Optional[bytes]]:
+    """Get frames with concurrent single-frame requests."""
+    executor = _get_executor()
+    futures = [
+        executor.submit(_get_frame_safe, chunk_id, frame_id)
+        for chunk_id, frame_id in frames
+    ]
+    return _wait(futures, [
+        f'frame {frame_id} of chunk {chunk_id}'
+        for chunk_id, frame_id in frames
+    ])
+
+
+def get_frames(frames: list[tuple[int, int]]) -> list[Optional[bytes]]:
+    """
+    Get several frames from source manager concurrently.
+
+    Frames are grouped by video chunk. Frames of the same chunk are
+    requested with a single multi-frame request, so every chunk is
+    decoded once, lone frames with a single-frame request. If source
+    manager doesn't have the multi-frame route, or a multi-frame request
+    fails, frames are requested one by one instead. Missing route is
+    remembered for `frame_multi_route_ttl` seconds.
+
+    At most `frame_fetch_concurrency` requests are made at once. Every
+    request is limited by `frame_fetch_timeout` seconds, so waiting for
+    all of the frames is bounded by the timeout times number of rounds of
+    concurrent requests, not by the sum of request times. Frames which
+    failed or didn't arrive in time are returned as None, so the rest of
+    them can still be shown.
+
+    Parameters:
+    - frames (list[tuple[int, int]]): chunk ids and frame positions
+
+    Returns:
+    - list[Optional[bytes]]: encoded frames in the same order, None for
+        missing frames
+    """
+    if not frames:
+        return []
+    if _single_frame_only_now():
+        return _get_frames_single(frames)
+
+    chunks: dict[int, list[int]] = {}
+    for chunk_id, frame_id in frames:
+        frame_ids = chunks.setdefault(chunk_id, [])
+        if frame_id not in frame_ids:
+            frame_ids.append(frame_id)
+    executor = _get_executor()
+    futures = [
+        executor.submit(_get_chunk_frames_safe, chunk_id, frame_ids)
+        if len(frame_ids) > 1 else
+        executor.submit(_get_frame_safe, chunk_id, frame_ids[0])
+        for chunk_id, frame_ids in chunks.items()
+    ]
+    results = _wait(
+        futures, [f'frames of chunk {chunk_id}' for chunk_id in chunks]
+    )
+
+    found: dict[tuple[int, int], Optional[bytes]] = {}
+    retry = []
+    for (chunk_id, frame_ids), future, result in zip(
+        chunks.items(), futures, results
+    ):
+        if len(frame_ids) == 1:
+            found[chunk_id, frame_ids[0]] = result
+        elif result is None and future.done():
+            retry.extend((chunk_id, frame_id) for frame_id in frame_ids)
+        else:
+            for frame_id, frame in zip(frame_ids, result or ()):
+                found[chunk_id, frame_id] = frame
+    if retry:
+        found.update(zip(retry, _get_frames_single(retry)))
+    return [found.get(frame) for frame in frames]
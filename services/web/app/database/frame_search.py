@@ -1,87 +1,369 @@
 from typing import Optional
-
-from pydantic import BaseModel
-from redis.exceptions import ResponseError
-from redis.commands.search.indexDefinition import IndexDefinition
-from redis.commands.search.field import VectorField, TagField, NumericField
-from redis.commands.search.query import Query
+from hashlib import sha1
+import base64
+import json
+import secrets
+import threading
+import time
 
 from common.config import settings
-from app.database import connection
-
-
-index_def = IndexDefinition(
-    prefix=['frame:'],
-)
-
-schema = (
-    TagField('source_manager_id'),
-    TagField('source_id'),
-    NumericField('timestamp'),
-    VectorField(
-        name='embedding',
-        algorithm='HNSW',
-        attributes={
-            'TYPE': 'FLOAT32',
-            'DIM': settings.web.hnsw_dim,
-            'DISTANCE_METRIC': settings.web.hnsw_distance_metric,
-            'INITIAL_CAP': settings.web.hnsw_initial_cap,
-            'M': settings.web.hnsw_m,
-            'EF_CONSTRUCTION': settings.web.hnsw_ef_construction,
-            'EF_RUNTIME': settings.web.hnsw_ef_runtime,
-            'EPSILON': settings.web.hnsw_epsilon,
-        }
-    ),
-)
-
-# Create index if it doesn't exist, or recreate it if such option is enabled
-try:
-    connection.ft('frame_idx').info()
-    if settings.web.hnsw_recreate_index_on_startup:
-        connection.ft('frame_idx').dropindex(delete_documents=False)
-        connection.ft('frame_idx').create_index(schema, definition=index_def)
-except ResponseError:
-    connection.ft('frame_idx').create_index(schema, definition=index_def)
-
-
-class Frame(BaseModel):
-    source_id: int
-    chunk_id: int
-    position: int
-    timestamp: float
-    box: list[int]
+from app.database import connection, vector_store
+from app.database.vector_store import Frame
+
+
+_store: Optional[vector_store.VectorStore] = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> vector_store.VectorStore:
+    """
+    Get configured vector store.
+    Store is created and its index is prepared on first use, not on import.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = vector_store.create(settings.web.vector_store)
+                store.create_index()
+                _store = store
+    return _store
+
+
+# Search result cache
+
+cache_stats = {'hits': 0, 'misses': 0, 'stale': 0}
+
+
+def _epoch_key(source_manager_id: str) -> str:
+    return f'search_cache:epoch:{source_manager_id}'
+
+
+def _cache_key(query_embedding: bytes, version: str, top_k: int,
+               *filters) -> str:
+    digest = sha1(query_embedding)
+    digest.update(':'.join(map(str, (version, top_k, *filters))).encode())
+    return f'search_cache:{digest.hexdigest()}'
+
+
+def _cache_ttl(time_end: Optional[float]) -> int:
+    """
+    Closed time windows far enough in the past won't get new frames, so
+    their results are kept much longer than results of open windows.
+    """
+    closed_before = time.time() - settings.web.search_cache_closed_after
+    if time_end is not None and time_end < closed_before:
+        return settings.web.search_cache_closed_ttl
+    return settings.web.search_cache_open_ttl
+
+
+def invalidate(source_manager_id: str):
+    """
+    Invalidate cached search results of the source manager.
+
+    Parameters:
+    - source_manager_id (str): id of the source manager
+    """
+    connection.incr(_epoch_key(source_manager_id))
+
+
+def register(source_manager_id: str):
+    """
+    Prepare vector store for frames of a new source manager.
+
+    Parameters:
+    - source_manager_id (str): id of the source manager
+    """
+    get_store().register(source_manager_id)
+
+
+def unregister(source_manager_id: str):
+    """
+    Invalidate cached search results of the source manager and release
+    vector store resources held for its frames.
+
+    Parameters:
+    - source_manager_id (str): id of the source manager
+    """
+    invalidate(source_manager_id)
+    get_store().unregister(source_manager_id)
+
+
+def cache_info() -> dict:
+    """
+    Get search result cache statistics for the current worker.
+
+    Returns:
+    - dict: hit/miss counters and hit rate, `stale` counts cached results
+        dropped because new frames were ingested since they were cached
+    """
+    info = dict(cache_stats)
+    total = info['hits'] + info['misses']
+    info['hit_rate'] = info['hits'] / total if total else 0.0
+    return info
+
+
+def plan(
+    top_k: int,
+    source_manager_id: str,
+    time_start: Optional[float],
+    time_end: Optional[float],
+) -> dict:
+    """
+    Get query plan the vector store chooses for the search, for debugging.
+
+    Parameters:
+    - top_k (int): number of frames to find
+    - source_manager_id (str): id of the source manager frames belong to
+    - time_start (float): minimal frame timestamp, if any
+    - time_end (float): maximal frame timestamp, if any
+
+    Returns:
+    - dict: query plan, e.g. hybrid policy and its parameters
+    """
+    return get_store().plan(top_k, source_manager_id, time_start, time_end)
 
 
 def find(
     query_embedding: bytes,
     top_k: int,
-    source_manager_id: int,
+    source_manager_id: str,
     time_start: Optional[float],
     time_end: Optional[float],
-):
-    if time_start is None:
-        time_start = '-inf'
-    if time_end is None:
-        time_end = '+inf'
-
-    filter = '@source_manager_id:{{{}}} @timestamp:[{} {}]'.format(
-        source_manager_id, time_start, time_end
+) -> list[Frame]:
+    """
+    Find frames closest to the query embedding.
+
+    Results are cached, see `find_many`.
+
+    Parameters:
+    - query_embedding (bytes): float32 query vector
+    - top_k (int): number of frames to find
+    - source_manager_id (str): id of the source manager frames belong to
+    - time_start (float): minimal frame timestamp, if any
+    - time_end (float): maximal frame timestamp, if any
+
+    Returns:
+    - list[Frame]: found frames, closest first
+    """
+    return find_many(
+        [query_embedding], top_k, source_manager_id, time_start, time_end
+    )[0]
+
+
+def find_many(
+    query_embeddings: list[bytes],
+    top_k: int,
+    source_manager_id: str,
+    time_start: Optional[float],
+    time_end: Optional[float],
+) -> list[list[Frame]]:
+    """
+    Find frames closest to each of the query embeddings.
+
+    All queries share the same filters and are run by the configured
+    vector store at once.
+
+    Results are cached in Redis by query vector and filters. Every cached
+    result stores a fingerprint of the data it was computed on: number of
+    frames matching the filters and the source manager cache epoch.
+    Ingestion of new frames into the searched window, or `invalidate` call,
+    makes cached results stale.
+
+    Parameters:
+    - query_embeddings (list[bytes]): float32 query vectors
+    - top_k (int): number of frames to find for each query
+    - source_manager_id (str): id of the source manager frames belong to
+    - time_start (float): minimal frame timestamp, if any
+    - time_end (float): maximal frame timestamp, if any
+
+    Returns:
+    - list[list[Frame]]: found frames for each query, closest first
+    """
+    store = get_store()
+    filters = (source_manager_id, time_start, time_end)
+    if not settings.web.search_cache_enabled:
+        return store.search_many(query_embeddings, top_k, *filters)
+
+    version = f'{settings.web.vector_store}:{store.cache_version()}'
+    keys = [
+        _cache_key(e, version, top_k, *filters) for e in query_embeddings
+    ]
+    # Count of matching frames is sent along, so a hit costs a single
+    # round trip to Redis, though the filter is still evaluated by it
+    count_command = store.count_command(*filters)
+    pipe = connection.pipeline(transaction=False)
+    pipe.get(_epoch_key(source_manager_id))
+    pipe.mget(keys)
+    if count_command is not None:
+        pipe.execute_command(*count_command)
+    epoch, cached, *count = pipe.execute()
+    if count_command is not None:
+        count = store.count_reply(count[0])
+    else:
+        count = store.count(*filters)
+    fingerprint = '{}:{}'.format(int(epoch or 0), count)
+
+    results = [None] * len(keys)
+    for i, value in enumerate(cached):
+        if value is None:
+            continue
+        value = json.loads(value)
+        if value['fingerprint'] != fingerprint:
+            cache_stats['stale'] += 1
+            continue
+        results[i] = [Frame(*frame) for frame in value['frames']]
+    missing = [i for i, result in enumerate(results) if result is None]
+    cache_stats['hits'] += len(keys) - len(missing)
+    cache_stats['misses'] += len(missing)
+    if not missing:
+        return results
+
+    found = store.search_many(
+        [query_embeddings[i] for i in missing], top_k, *filters
     )
-    query = f'({filter})=>[KNN {top_k} @embedding $query_embedding AS score]'
-    query_params = {'query_embedding': query_embedding}
-    results = connection.ft('frame_idx').search(
-        Query(query).sort_by('score').dialect(2),
-        query_params=query_params
+    ttl = _cache_ttl(time_end)
+    pipe = connection.pipeline(transaction=False)
+    for i, frames in zip(missing, found):
+        results[i] = frames
+        value = json.dumps({
+            'fingerprint': fingerprint,
+            'frames': [
+                [getattr(frame, name) for name in Frame.__slots__]
+                for frame in frames
+            ],
+        })
+        pipe.set(keys[i], value, ex=ttl)
+    pipe.execute()
+    return results
+
+
+# Paginated search
+
+class CursorNotFound(Exception):
+    """Raised when search cursor has expired or belongs to another source
+    manager."""
+
+
+def _cursor_key(token: str) -> str:
+    return f'search_cursor:{token}'
+
+
+def cursor_offset(cursor: Optional[str]) -> int:
+    """
+    Get offset of the page cursor points to, 0 for malformed cursors.
+
+    Parameters:
+    - cursor (str): page cursor
+
+    Returns:
+    - int: number of frames on previous pages
+    """
+    try:
+        return max(int((cursor or '').rsplit(':', 1)[1]), 0)
+    except (IndexError, ValueError):
+        return 0
+
+
+def open_cursor(
+    query_embedding: bytes,
+    source_manager_id: str,
+    time_start: Optional[float],
+    time_end: Optional[float],
+    offset: int = 0,
+) -> str:
+    """
+    Open server-side cursor over search results.
+
+    Cursor keeps the query and the candidate list found for it so far, in
+    Redis for `search_cursor_ttl` seconds since the last page. No search is
+    run until the first page is requested with `find_page`.
+
+    Parameters:
+    - query_embedding (bytes): float32 query vector
+    - source_manager_id (str): id of the source manager frames belong to
+    - time_start (float): minimal frame timestamp, if any
+    - time_end (float): maximal frame timestamp, if any
+    - offset (int): number of frames to skip
+
+    Returns:
+    - str: cursor of the page at the offset
+    """
+    token = secrets.token_urlsafe(16)
+    state = {
+        'query_embedding': base64.b64encode(query_embedding).decode(),
+        'filters': [source_manager_id, time_start, time_end],
+        'depth': 0,
+        'complete': False,
+        'frames': [],
+    }
+    connection.set(
+        _cursor_key(token), json.dumps(state),
+        ex=settings.web.search_cursor_ttl,
     )
+    return f'{token}:{offset}'
+
+
+def find_page(
+    cursor: str,
+    page_size: int,
+    source_manager_id: str,
+) -> tuple[list[Frame], Optional[str]]:
+    """
+    Get page of search results.
+
+    Page is served from the candidate list cached in the cursor. Only when
+    the list is exhausted the KNN query is extended: rerun with k large
+    enough for `search_cursor_prefetch` pages, at least doubling the
+    previous k, up to `search_cursor_max_depth`. Frames already in the list
+    keep their places, so pages don't repeat frames, even if a deeper
+    query ranks neighbours of the approximate index slightly differently.
+
+    Parameters:
+    - cursor (str): page cursor returned by `open_cursor` or `find_page`
+    - page_size (int): number of frames on the page
+    - source_manager_id (str): id of the source manager frames belong to
 
-    frames = []
-    for doc in results.docs:
-        frame = Frame(
-            source_id=doc.source_id,
-            chunk_id=doc.chunk_id,
-            position=doc.position,
-            timestamp=doc.timestamp,
-            box=list(map(int, doc.box.split(',')))
+    Returns:
+    - list[Frame]: frames of the page, closest first
+    - str: cursor of the next page, None if there are no more frames
+
+    Raises:
+    - CursorNotFound: if cursor has expired or belongs to another
+        source manager
+    """
+    token = (cursor or '').rsplit(':', 1)[0]
+    offset = cursor_offset(cursor)
+    key = _cursor_key(token)
+    state = connection.get(key) if token else None
+    if state is None:
+        raise CursorNotFound()
+    state = json.loads(state)
+    if state['filters'][0] != source_manager_id:
+        raise CursorNotFound()
+
+    frames = state['frames']
+    end = offset + page_size
+    max_depth = settings.web.search_cursor_max_depth
+    if len(frames) < end and not state['complete']:
+        top_k = max(
+            end + page_size * (settings.web.search_cursor_prefetch - 1),
+            state['depth'] * 2,
         )
-        frames.append(frame)
-    return frames
+        top_k = min(top_k, max_depth)
+        query_embedding = base64.b64decode(state['query_embedding'])
+        found = find(query_embedding, top_k, *state['filters'])
+        seen = {(f[1], f[2], tuple(f[4])) for f in frames}
+        for frame in found:
+            values = [getattr(frame, name) for name in Frame.__slots__]
+            if (frame.chunk_id, frame.position, tuple(frame.box)) not in seen:
+                frames.append(values)
+        state['depth'] = top_k
+        state['complete'] = len(found) < top_k or top_k >= max_depth
+    connection.set(key, json.dumps(state), ex=settings.web.search_cursor_ttl)
+
+    page = [Frame(*frame) for frame in frames[offset:end]]
+    has_next = end < len(frames) or (
+        not state['complete'] and end < max_depth
+    )
+    return page, f'{token}:{end}' if has_next else None
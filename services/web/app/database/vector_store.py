@@ -0,0 +1,1598 @@
+import fcntl
+import json
+import logging
+import math
+import os
+import threading
+import time
+from hashlib import sha1
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from redis.exceptions import LockError, ResponseError
+from redis.lock import Lock
+from redis.commands.search.indexDefinition import IndexDefinition
+from redis.commands.search.field import VectorField, TagField, NumericField
+
+from common.config import settings
+from app.database import connection
+
+
+logger = logging.getLogger(__name__)
+
+# Fields returned by search, everything else (e.g. embedding) stays in Redis
+RETURN_FIELDS = ('source_id', 'chunk_id', 'position', 'timestamp', 'box')
+
+
+class Frame:
+    """
+    Frame found by vector search.
+
+    Lightweight record instead of a pydantic model: search results are
+    produced by the index itself and don't need validation.
+
+    Attributes:
+    - source_id (int): id of the source frame belongs to
+    - chunk_id (int): id of the video chunk frame belongs to
+    - position (int): frame position in the video chunk
+    - timestamp (float): frame timestamp
+    - box (list[int]): bounding box of the found object (xyxy)
+    - score (float): distance between frame and query embeddings
+    """
+    __slots__ = (
+        'source_id', 'chunk_id', 'position', 'timestamp', 'box', 'score'
+    )
+
+    def __init__(self, source_id: int, chunk_id: int, position: int,
+                 timestamp: float, box: list[int], score: float):
+        self.source_id = source_id
+        self.chunk_id = chunk_id
+        self.position = position
+        self.timestamp = timestamp
+        self.box = box
+        self.score = score
+
+    def dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        return 'Frame({})'.format(', '.join(
+            f'{name}={getattr(self, name)!r}' for name in self.__slots__
+        ))
+
+
+def distances(embeddings: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    """
+    Distances between embeddings and queries in `hnsw_distance_metric`,
+    as they are reported by RediSearch.
+
+    Parameters:
+    - embeddings (np.ndarray): matrix of shape (n, dim)
+    - queries (np.ndarray): matrix of shape (m, dim)
+
+    Returns:
+    - np.ndarray: distance matrix of shape (n, m)
+    """
+    metric = settings.web.hnsw_distance_metric
+    if metric == 'L2':
+        return (
+            (embeddings ** 2).sum(axis=1)[:, None]
+            - 2 * embeddings @ queries.T
+            + (queries ** 2).sum(axis=1)[None, :]
+        )
+    if metric == 'COSINE':
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.maximum(norms, 1e-12)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.maximum(norms, 1e-12)
+    return 1 - embeddings @ queries.T
+
+
+class Compressor:
+    """
+    Converts full-precision frame embeddings into vectors stored in the
+    index field.
+
+    Vectors are optionally projected onto the top principal directions of
+    frame embeddings and stored as FLOAT16. Projection is fitted once on
+    a sample of frames and shared by all workers through Redis.
+
+    Every representation is stored in its own hash field, e.g.
+    `embedding_float16_128`, so several of them may coexist while index
+    is being rebuilt. Uncompressed vectors are the original `embedding`.
+
+    Attributes:
+    - type (str): element type of stored vectors, 'FLOAT32' or 'FLOAT16'
+    - dim (int): dimension of stored vectors
+    - components (np.ndarray): projection matrix of shape (hnsw_dim, dim),
+        None until it's loaded or fitted, or if vectors aren't projected
+    """
+
+    DTYPES = {
+        'FLOAT32': 'float32',
+        'FLOAT16': 'float16',
+    }
+
+    def __init__(self, type: str, dim: int):
+        self.type = type
+        self.dim = dim
+        self.components: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_field(cls, field: str) -> 'Compressor':
+        """Get compressor writing given hash field."""
+        if field == 'embedding':
+            return cls('FLOAT32', settings.web.hnsw_dim)
+        _, type, dim = field.split('_')
+        return cls(type.upper(), int(dim))
+
+    @property
+    def projected(self) -> bool:
+        return self.dim != settings.web.hnsw_dim
+
+    @property
+    def compressed(self) -> bool:
+        return self.type != 'FLOAT32' or self.projected
+
+    @property
+    def field(self) -> str:
+        """Name of the hash field with vectors."""
+        if not self.compressed:
+            return 'embedding'
+        return f'embedding_{self.type.lower()}_{self.dim}'
+
+    @property
+    def ready(self) -> bool:
+        return not self.projected or self.components is not None
+
+    def load(self) -> bool:
+        """
+        Load projection, fit it if it wasn't fitted yet and there are
+        enough frames for that.
+
+        Returns:
+        - bool: True if compressor is ready to use
+        """
+        if self.ready:
+            return True
+        key = f'frame_idx:pca:{self.dim}'
+        data = connection.get(key)
+        if data is None:
+            components = self.fit()
+            if components is None:
+                return False
+            # Other worker may have fitted it at the same time, the first
+            # stored projection is used by everyone
+            connection.set(key, components.tobytes(), nx=True)
+            data = connection.get(key)
+        self.components = np.frombuffer(data, dtype='float32').reshape(
+            settings.web.hnsw_dim, self.dim
+        )
+        return True
+
+    def fit(self) -> Optional[np.ndarray]:
+        """
+        Fit projection on a sample of frame embeddings.
+
+        Vectors are not centered: projection keeps the subspace where inner
+        products and distances between frame embeddings vary the most,
+        so it works the same way for queries and for every metric.
+
+        Returns:
+        - np.ndarray: projection matrix, None if there are not enough frames
+        """
+        samples = settings.web.hnsw_pca_samples
+        keys = []
+        for key in connection.scan_iter('frame:*', 1000):
+            keys.append(key)
+            if len(keys) >= samples:
+                break
+        if len(keys) < 10 * self.dim:
+            logger.warning(
+                'Not enough frames to fit projection: %d < %d',
+                len(keys), 10 * self.dim
+            )
+            return None
+        pipe = connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.hget(key, 'embedding')
+        sample = np.frombuffer(
+            b''.join(e for e in pipe.execute() if e is not None),
+            dtype='float32',
+        ).reshape(-1, settings.web.hnsw_dim)
+        _, _, vt = np.linalg.svd(sample, full_matrices=False)
+        return np.ascontiguousarray(vt[:self.dim].T, dtype='float32')
+
+    def __call__(self, embeddings: np.ndarray) -> np.ndarray:
+        """
+        Compress float32 embeddings.
+
+        Parameters:
+        - embeddings (np.ndarray): matrix of shape (n, hnsw_dim)
+
+        Returns:
+        - np.ndarray: matrix of shape (n, dim) in element type of the field
+        """
+        if self.projected:
+            embeddings = embeddings @ self.components
+        return embeddings.astype(self.DTYPES[self.type])
+
+
+class Histogram:
+    """
+    Equi-width histogram of frame timestamps, used to estimate how many
+    frames fall into a time window without querying the index.
+
+    Attributes:
+    - bucket (float): bucket width in seconds
+    - total (int): total number of frames
+    """
+
+    def __init__(self, bucket: float, counts: dict[int, int]):
+        self.bucket = bucket
+        # Bucket numbers, i.e. floor(timestamp / bucket), and cumulative
+        # number of frames up to the end of each bucket
+        self._buckets = np.array(sorted(counts), dtype='int64')
+        self._counts = np.array(
+            [counts[b] for b in self._buckets], dtype='int64'
+        )
+        self._cumulative = np.cumsum(self._counts)
+        self.total = int(self._cumulative[-1]) if counts else 0
+
+    def _below(self, timestamp: Optional[float], default: float) -> float:
+        """Estimate number of frames with smaller timestamp."""
+        if timestamp is None:
+            return default
+        x = timestamp / self.bucket
+        bucket = math.floor(x)
+        i = int(np.searchsorted(self._buckets, bucket))
+        below = float(self._cumulative[i - 1]) if i > 0 else 0.0
+        if i < len(self._buckets) and self._buckets[i] == bucket:
+            below += self._counts[i] * (x - bucket)
+        return below
+
+    def estimate(self, time_start: Optional[float],
+                 time_end: Optional[float]) -> float:
+        """
+        Estimate number of frames in time window.
+        Frames are assumed to be spread uniformly within a bucket.
+
+        Parameters:
+        - time_start (float): window start, if any
+        - time_end (float): window end, if any
+
+        Returns:
+        - float: estimated number of frames
+        """
+        return self._below(time_end, self.total) - self._below(time_start, 0)
+
+
+class VectorStore:
+    """
+    Base class of frame vector stores.
+
+    Frames are filtered by the source manager they belong to and by
+    timestamp, then ranked by distance to the query vector. Scores follow
+    RediSearch conventions for `hnsw_distance_metric`: squared euclidean
+    distance for L2, one minus inner product for IP and one minus cosine
+    similarity for COSINE, so lower is always closer.
+    """
+
+    def create_index(self):
+        """Prepare the store for search, called once before first query."""
+
+    def info(self, source_manager_id: Optional[str] = None) -> dict:
+        """
+        Get store state for monitoring.
+
+        Parameters:
+        - source_manager_id (str): id of the source manager, state of
+            stores kept apart for other source managers isn't included
+
+        Returns:
+        - dict: store state
+        """
+        return {}
+
+    def register(self, source_manager_id: str):
+        """Prepare the store for frames of a new source manager."""
+
+    def unregister(self, source_manager_id: str):
+        """Release resources held for frames of the source manager."""
+
+    def cache_version(self) -> str:
+        """
+        Get fingerprint of store parameters search results depend on.
+        Cached results found with other parameters aren't used.
+        """
+        return ''
+
+    def plan(self, top_k: int, source_manager_id: str,
+             time_start: Optional[float], time_end: Optional[float]) -> dict:
+        """
+        Get plan the store uses for filtered KNN query, for debugging.
+
+        Parameters:
+        - top_k (int): number of frames to find
+        - source_manager_id (str): id of the source manager
+        - time_start (float): minimal frame timestamp, if any
+        - time_end (float): maximal frame timestamp, if any
+
+        Returns:
+        - dict: query plan
+        """
+        return {}
+
+    def count(self, source_manager_id: str, time_start: Optional[float],
+              time_end: Optional[float]) -> int:
+        """
+        Count frames matching the filters.
+
+        Parameters:
+        - source_manager_id (str): id of the source manager
+        - time_start (float): minimal frame timestamp, if any
+        - time_end (float): maximal frame timestamp, if any
+
+        Returns:
+        - int: number of matching frames
+        """
+        raise NotImplementedError()
+
+    def count_command(self, source_manager_id: str,
+                      time_start: Optional[float],
+                      time_end: Optional[float]) -> Optional[tuple]:
+        """
+        Get Redis command counting frames matching the filters, so it can
+        be sent in one pipeline with other commands. Its reply is parsed
+        with `count_reply`.
+
+        Parameters:
+        - source_manager_id (str): id of the source manager
+        - time_start (float): minimal frame timestamp, if any
+        - time_end (float): maximal frame timestamp, if any
+
+        Returns:
+        - tuple: command arguments, None if the store doesn't count frames
+            in Redis, then `count` has to be used
+        """
+        return None
+
+    def count_reply(self, reply) -> int:
+        """Get number of frames from reply of `count_command`."""
+        raise NotImplementedError()
+
+    def search_many(self, query_embeddings: list[bytes], top_k: int,
+                    source_manager_id: str, time_start: Optional[float],
+                    time_end: Optional[float]) -> list[list[Frame]]:
+        """
+        Find frames closest to each of the query embeddings.
+
+        Parameters:
+        - query_embeddings (list[bytes]): float32 query vectors
+        - top_k (int): number of frames to find for each query
+        - source_manager_id (str): id of the source manager
+        - time_start (float): minimal frame timestamp, if any
+        - time_end (float): maximal frame timestamp, if any
+
+        Returns:
+        - list[list[Frame]]: found frames for each query, closest first
+        """
+        raise NotImplementedError()
+
+
+class RediSearchStore(VectorStore):
+    """
+    Approximate search with HNSW index provided by RediSearch.
+    Index covers frame hashes written by frame processing workers.
+
+    Queries always go to `frame_idx` alias, which points to one of the
+    versioned indexes `frame_idx_v{n}`. Index with new parameters is built
+    next to the live one, and the alias is switched to it only when all
+    frames are indexed, so search is never empty while HNSW graph is being
+    rebuilt. Only one rebuild runs at a time, it is guarded by a lock
+    in Redis shared by all workers.
+
+    Index may also cover frames of a single source manager only, see
+    `PartitionedStore`.
+
+    Index field may hold compressed vectors, see `Compressor`. They are
+    written into frame hashes by a background job, as frames are produced
+    outside of this service with full-precision embeddings only. Then
+    `k * hnsw_rerank_oversample` candidates found by the index are
+    re-ranked exactly with full-precision embeddings.
+
+    Attributes:
+    - index_name (str): name of the alias queries go to
+    - prefix (str): prefix of frame keys covered by the index
+    - tenant (str): id of the source manager, if index covers frames of
+        this source manager only
+    """
+
+    compressor = Compressor(
+        settings.web.hnsw_type,
+        settings.web.hnsw_pca_dim or settings.web.hnsw_dim,
+    )
+
+    vector_attributes = {
+        'TYPE': compressor.type,
+        'DIM': compressor.dim,
+        'DISTANCE_METRIC': settings.web.hnsw_distance_metric,
+        'INITIAL_CAP': settings.web.hnsw_initial_cap,
+        'M': settings.web.hnsw_m,
+        'EF_CONSTRUCTION': settings.web.hnsw_ef_construction,
+        'EF_RUNTIME': settings.web.hnsw_ef_runtime,
+        'EPSILON': settings.web.hnsw_epsilon,
+    }
+
+    schema = (
+        TagField('source_manager_id'),
+        TagField('source_id'),
+        NumericField('timestamp'),
+        VectorField(
+            name=compressor.field,
+            algorithm='HNSW',
+            attributes=vector_attributes,
+        ),
+    )
+
+    # Fingerprint of index parameters, changing them triggers a rebuild
+    schema_hash = sha1(json.dumps(
+        [compressor.field, vector_attributes], sort_keys=True
+    ).encode()).hexdigest()
+
+    # Fingerprint of parameters results depend on, besides the live field
+    results_hash = sha1(json.dumps([
+        schema_hash,
+        settings.web.hnsw_rerank_oversample,
+        {
+            name: value for name, value in settings.web.dict().items()
+            if name.startswith('hybrid_')
+        },
+    ], sort_keys=True).encode()).hexdigest()
+
+    # How long a worker trusts its knowledge of the live index field
+    field_ttl = 60
+
+    def __init__(self, index_name: str = 'frame_idx',
+                 prefix: str = 'frame:', tenant: Optional[str] = None):
+        self.index_name = index_name
+        self.prefix = prefix
+        self.tenant = tenant
+        self.version_key = f'{index_name}:version'
+        self.schema_key = f'{index_name}:schema'
+        self.reindex_key = f'{index_name}:reindex'
+        self.lock_key = f'{index_name}:lock'
+        self.pending_key = f'{index_name}:pending'
+        self.index_def = IndexDefinition(prefix=[prefix])
+        self._histograms: dict[str, tuple[float, tuple[Histogram, int]]] = {}
+        self._live_compressor: tuple[float, Optional[Compressor]] = (0, None)
+        self._compressing = False
+
+    def live_index(self) -> Optional[str]:
+        """Get name of the index the alias points to, if any."""
+        try:
+            info = connection.ft(self.index_name).info()
+        except ResponseError:
+            return None
+        name = info['index_name']
+        return name.decode() if isinstance(name, bytes) else name
+
+    def _build(self) -> str:
+        """Create new versioned index, it starts indexing in background."""
+        version = connection.incr(self.version_key)
+        name = f'{self.index_name}_v{version}'
+        # Recorded first, so the index can't be left behind unnoticed
+        connection.hset(self.schema_key, name, self.schema_hash)
+        connection.ft(name).create_index(
+            self.schema, definition=self.index_def
+        )
+        return name
+
+    def _drop_stale(self, keep: set[str]):
+        """Drop versioned indexes left behind by failed rebuilds."""
+        for name in connection.hkeys(self.schema_key):
+            name = name.decode()
+            if name in keep:
+                continue
+            logger.info('Dropping stale index %s', name)
+            try:
+                connection.ft(name).dropindex(delete_documents=False)
+            except ResponseError:
+                pass  # Never created or already dropped
+            connection.hdel(self.schema_key, name)
+
+    def _swap(self, name: str, old_name: Optional[str]):
+        """Point alias to the new index and drop the old one."""
+        if old_name == self.index_name:
+            # Index created before aliases were used has the alias name
+            connection.ft(old_name).dropindex(delete_documents=False)
+            old_name = None
+        if old_name is None:
+            connection.ft(name).aliasadd(self.index_name)
+        else:
+            connection.ft(name).aliasupdate(self.index_name)
+            connection.ft(old_name).dropindex(delete_documents=False)
+            connection.hdel(self.schema_key, old_name)
+
+    def create_index(self):
+        """
+        Create index and alias if they don't exist.
+        If index parameters have changed and `hnsw_recreate_index_on_startup`
+        is enabled, rebuild the index in background.
+        """
+        # Frames of partitioned indexes are compressed by the store which
+        # covers all of them. Loop runs even if compression is disabled, to
+        # drop pending indexes of fields which are no longer used
+        if self.tenant is None and not self._compressing:
+            self._compressing = True
+            threading.Thread(
+                target=self._compress_loop, name='compress', daemon=True
+            ).start()
+        with connection.lock(self.lock_key + ':create', timeout=60):
+            name = self.live_index()
+            if name is None:
+                self._swap(self._build(), None)
+                return
+        if not settings.web.hnsw_recreate_index_on_startup:
+            return
+        if connection.hget(self.schema_key, name) != self.schema_hash.encode():
+            self.reindex(wait=False)
+
+    def drop(self):
+        """Drop all versions of the index and their state, frames are kept."""
+        names = {self.live_index()}
+        names.update(
+            name.decode() for name in connection.hkeys(self.schema_key)
+        )
+        names.discard(None)
+        for name in names:
+            try:
+                connection.ft(name).dropindex(delete_documents=False)
+            except ResponseError:
+                pass  # Already dropped
+        connection.delete(self.version_key, self.schema_key, self.reindex_key)
+        self._drop_pending(set())
+
+    def reindex(self, wait: bool = True) -> bool:
+        """
+        Rebuild index with current parameters without downtime.
+
+        New versioned index is created and polled with FT.INFO until all
+        documents are indexed. Then alias is switched to it and the old
+        index is dropped, documents themselves are kept. Rebuild abandoned
+        by a process which has died is resumed instead of started over.
+
+        Parameters:
+        - wait (bool): block until rebuild is done, otherwise it runs in
+            a background thread
+
+        Returns:
+        - bool: False if other rebuild is already running
+        """
+        # Lock expires soon after its owner dies, it's renewed on every poll.
+        # It's acquired here, but renewed and released by the rebuild
+        # thread, so its token can't be thread-local
+        timeout = max(60, 3 * settings.web.hnsw_reindex_poll_interval)
+        lock = connection.lock(
+            self.lock_key, timeout=timeout, thread_local=False
+        )
+        if not lock.acquire(blocking=False):
+            return False
+        if wait:
+            self._reindex(lock)
+        else:
+            threading.Thread(
+                target=self._reindex, args=(lock,), name='reindex',
+                daemon=True,
+            ).start()
+        return True
+
+    def _reindex(self, lock):
+        name = None
+        try:
+            state = connection.hgetall(self.reindex_key)
+            if state.get(b'state') == b'indexing':
+                name = state[b'index'].decode()
+                old_name = state[b'replaces'].decode() or None
+            else:
+                old_name = self.live_index()
+                self._drop_stale({old_name})
+                name = self._build()
+                connection.hset(self.reindex_key, mapping={
+                    'index': name,
+                    'replaces': old_name or '',
+                    'state': 'indexing',
+                    'started_at': time.time(),
+                })
+            logger.info('Rebuilding %s as %s', old_name, name)
+            if self.compressor.compressed:
+                # New index can't go live before all frames have vectors
+                # in its field
+                while not self.compress([self.compressor], lock=lock):
+                    lock.reacquire()
+                    time.sleep(settings.web.hnsw_reindex_poll_interval)
+            while True:
+                lock.reacquire()
+                info = connection.ft(name).info()
+                percent_indexed = float(info['percent_indexed'])
+                if int(info['indexing']) == 0 and percent_indexed >= 1:
+                    break
+                logger.info('%s: %.1f%% indexed', name, percent_indexed * 100)
+                time.sleep(settings.web.hnsw_reindex_poll_interval)
+            self._swap(name, old_name)
+            connection.hset(self.reindex_key, 'state', 'done')
+            if self.tenant is not None:
+                # Later frames are compressed by the store covering all
+                # partitions
+                self._drop_pending(set())
+            logger.info('Index %s is live', name)
+        except Exception:
+            logger.exception('Index rebuild failed')
+            # Next rebuild starts over, so the half-built index is dropped
+            # instead of being left in Redis
+            live = self.live_index()
+            if name is not None and name != live:
+                self._drop_stale({live})
+            connection.hset(self.reindex_key, 'state', 'failed')
+            raise
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                pass  # Expired, other rebuild may be running already
+
+    def _pending(self, field: str) -> str:
+        """
+        Get name of the index of frames without the hash field.
+        Index is created if it doesn't exist yet.
+
+        Frames leave the index as soon as the field is written into them,
+        so it holds only new frames and, most of the time, is empty.
+        """
+        name = f'{self.index_name}_pending_{field}'
+        try:
+            connection.execute_command(
+                'FT.CREATE', name, 'ON', 'HASH', 'PREFIX', 1, self.prefix,
+                'FILTER', f'!exists(@{field})',
+                'SCHEMA', 'timestamp', 'NUMERIC',
+            )
+        except ResponseError as e:
+            if 'already exists' not in str(e):
+                raise
+        connection.sadd(self.pending_key, field)
+        return name
+
+    def _drop_pending(self, keep: set[str]):
+        """Drop pending indexes of fields which are no longer written."""
+        for field in connection.smembers(self.pending_key):
+            field = field.decode()
+            if field in keep:
+                continue
+            logger.info('Dropping pending index of %s', field)
+            try:
+                connection.ft(f'{self.index_name}_pending_{field}').dropindex(
+                    delete_documents=False
+                )
+            except ResponseError:
+                pass  # Already dropped
+            connection.srem(self.pending_key, field)
+
+    def compress(self, compressors: list[Compressor],
+                 batch_size: int = 1000, lock: Optional[Lock] = None) -> bool:
+        """
+        Write compressed vectors into frame hashes which don't have them.
+
+        Frames are taken from the pending index of every field, see
+        `_pending`, so the work depends on the number of new frames rather
+        than on the number of all frames. One call processes at most the
+        frames which were pending when it started.
+
+        Parameters:
+        - compressors (list[Compressor]): compressors to write fields of
+        - batch_size (int): number of frames processed in one pipeline
+        - lock (Lock): lock held by the caller, renewed after every batch,
+            so it doesn't expire while a large backlog is processed
+
+        Returns:
+        - bool: False if some of the compressors aren't ready yet or some
+            of the pending indexes are still being built
+        """
+        # Same field may be both configured and live one
+        compressors = list({
+            c.field: c for c in compressors if c.compressed
+        }.values())
+        if not all(c.load() for c in compressors):
+            return False
+        done = True
+        for compressor in compressors:
+            name = self._pending(compressor.field)
+            # Frames without embedding stay in the index, they are skipped
+            skipped = 0
+            remaining = None
+            while remaining is None or remaining > 0:
+                reply = connection.execute_command(
+                    'FT.SEARCH', name, '*', 'NOCONTENT',
+                    'LIMIT', skipped, batch_size,
+                )
+                if remaining is None:
+                    remaining = reply[0]
+                keys = reply[1:]
+                if not keys:
+                    break
+                remaining -= len(keys)
+                skipped += len(keys) - self._compress_batch(keys, compressor)
+                if lock is not None:
+                    lock.reacquire()
+            if int(connection.ft(name).info()['indexing']) != 0:
+                done = False
+        return done
+
+    def _compress_batch(self, keys: list[bytes],
+                        compressor: Compressor) -> int:
+        """Compress embeddings of frames, return number of written ones."""
+        pipe = connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.hget(key, 'embedding')
+        embeddings = pipe.execute()
+        written = 0
+        for key, embedding in zip(keys, embeddings):
+            if embedding is None:
+                continue  # Deleted in the meantime
+            embedding = np.frombuffer(embedding, dtype='float32')[None]
+            pipe.hset(key, compressor.field, compressor(embedding).tobytes())
+            written += 1
+        pipe.execute()
+        return written
+
+    def _compress_loop(self):
+        """
+        Keep compressing new frames for configured and live index fields,
+        drop pending indexes of other fields. Only one worker at a time
+        does it.
+        """
+        timeout = max(60, 3 * settings.web.hnsw_compress_interval)
+        while True:
+            lock = connection.lock(self.lock_key + ':compress',
+                                   timeout=timeout)
+            try:
+                if lock.acquire(blocking=False):
+                    try:
+                        compressors = [
+                            self.compressor, self.live_compressor(),
+                        ]
+                        self.compress(compressors, lock=lock)
+                        self._drop_pending({
+                            c.field for c in compressors if c.compressed
+                        })
+                    finally:
+                        lock.release()
+            except Exception:
+                logger.exception('Failed to compress frame embeddings')
+            time.sleep(settings.web.hnsw_compress_interval)
+
+    def live_compressor(self) -> Compressor:
+        """Get compressor of the live index field."""
+        fetched_at, compressor = self._live_compressor
+        if compressor is not None \
+                and time.monotonic() - fetched_at < self.field_ttl:
+            return compressor
+        info = connection.execute_command('FT.INFO', self.index_name)
+        info = dict(zip(info[::2], info[1::2]))
+        for attribute in info[b'attributes']:
+            attribute = dict(zip(attribute[::2], attribute[1::2]))
+            if attribute[b'type'] == b'VECTOR':
+                field = attribute[b'identifier'].decode()
+                break
+        if compressor is None or compressor.field != field:
+            if field == self.compressor.field:
+                compressor = self.compressor
+            else:
+                compressor = Compressor.from_field(field)
+        self._live_compressor = (time.monotonic(), compressor)
+        return compressor
+
+    def cache_version(self) -> str:
+        # Index being rebuilt with other parameters is not live yet
+        return f'{self.results_hash}:{self.live_compressor().field}'
+
+    def candidates(self, top_k: int) -> int:
+        """Number of candidates fetched from index to get `top_k` frames."""
+        if not self.live_compressor().compressed:
+            return top_k
+        return math.ceil(top_k * settings.web.hnsw_rerank_oversample)
+
+    def info(self, source_manager_id: Optional[str] = None) -> dict:
+        """
+        Get state of the last rebuild and its progress reported by FT.INFO.
+
+        Returns:
+        - dict: live index name, rebuilt index name, its state and, while
+            indexing, share of indexed documents and indexing failures
+        """
+        progress = {'live_index': self.live_index()}
+        state = connection.hgetall(self.reindex_key)
+        progress.update({k.decode(): v.decode() for k, v in state.items()})
+        if progress.get('state') == 'indexing':
+            try:
+                info = connection.ft(progress['index']).info()
+            except ResponseError:
+                return progress
+            progress['percent_indexed'] = float(info['percent_indexed'])
+            progress['num_docs'] = int(info['num_docs'])
+            progress['failures'] = int(info['hash_indexing_failures'])
+        return progress
+
+    def filter(self, source_manager_id: str, time_start: Optional[float],
+               time_end: Optional[float]) -> str:
+        """
+        Build query filter by source manager and time window.
+        Source manager filter is omitted if the index has only its frames,
+        '*' is returned if nothing has to be filtered.
+        """
+        filters = []
+        if self.tenant is None:
+            filters.append(f'@source_manager_id:{{{source_manager_id}}}')
+        if time_start is not None or time_end is not None:
+            filters.append('@timestamp:[{} {}]'.format(
+                '-inf' if time_start is None else time_start,
+                '+inf' if time_end is None else time_end,
+            ))
+        return ' '.join(filters) or '*'
+
+    def histogram(self, source_manager_id: str
+                  ) -> Optional[tuple[Histogram, int]]:
+        """
+        Get timestamp histogram of the source manager frames and total
+        number of frames in the index.
+
+        Frames are written by processing workers outside of this service,
+        so histogram is computed with FT.AGGREGATE instead of being updated
+        on ingest. It's kept in Redis and shared by all workers, when it's
+        older than `hybrid_histogram_ttl` seconds, one of the workers
+        recomputes it in background, so searches don't wait for it.
+
+        Returns:
+        - Optional[tuple[Histogram, int]]: histogram and number of frames,
+            None until the first histogram of the source manager is
+            computed
+        """
+        fetched_at, cached = self._histograms.get(
+            source_manager_id, (0.0, None)
+        )
+        ttl = settings.web.hybrid_histogram_ttl
+        if time.monotonic() - fetched_at < ttl:
+            return cached
+        key = f'{self.index_name}:histogram:{source_manager_id}'
+        data = connection.get(key)
+        data = json.loads(data) if data is not None else {}
+        if data.get('bucket') != settings.web.hybrid_histogram_bucket:
+            data = {}  # Computed with other settings
+        if time.time() - data.get('computed_at', 0) >= ttl:
+            self._refresh_histogram(source_manager_id, key)
+        if not data:
+            return None
+        cached = (
+            Histogram(data['bucket'], {
+                int(bucket): count for bucket, count in data['counts']
+            }),
+            data['num_docs'],
+        )
+        self._histograms[source_manager_id] = (time.monotonic(), cached)
+        return cached
+
+    def _refresh_histogram(self, source_manager_id: str, key: str):
+        """Recompute histogram in background, unless other worker does."""
+        # Lock is left to expire, so failed refreshes aren't retried by
+        # every search
+        if not connection.set(key + ':lock', 1, nx=True,
+                              ex=settings.web.hybrid_histogram_ttl):
+            return
+        threading.Thread(
+            target=self._compute_histogram, args=(source_manager_id, key),
+            name='histogram', daemon=True,
+        ).start()
+
+    def _compute_histogram(self, source_manager_id: str, key: str):
+        bucket = settings.web.hybrid_histogram_bucket
+        query = self.filter(source_manager_id, None, None)
+        pipe = connection.pipeline(transaction=False)
+        pipe.execute_command('FT.INFO', self.index_name)
+        pipe.execute_command(
+            'FT.SEARCH', self.index_name, query, 'LIMIT', 0, 0
+        )
+        pipe.execute_command(
+            'FT.AGGREGATE', self.index_name, query,
+            'LOAD', 1, '@timestamp',
+            'APPLY', f'floor(@timestamp / {bucket})', 'AS', 'bucket',
+            'GROUPBY', 1, '@bucket',
+            'REDUCE', 'COUNT', 0, 'AS', 'count',
+            'LIMIT', 0, settings.web.hybrid_histogram_max_buckets,
+            'TIMEOUT', settings.web.hybrid_histogram_timeout,
+        )
+        try:
+            info, found, reply = pipe.execute()
+        except ResponseError as e:
+            # Timed out with ON_TIMEOUT FAIL policy
+            logger.warning('Failed to compute timestamp histogram of %s: %s',
+                           source_manager_id, e)
+            return
+        num_docs = int(dict(zip(info[::2], info[1::2]))[b'num_docs'])
+        counts = {}
+        for fields in reply[1:]:
+            row = dict(zip(fields[::2], fields[1::2]))
+            counts[int(float(row[b'bucket']))] = int(row[b'count'])
+        if sum(counts.values()) < found[0]:
+            # Timed out with ON_TIMEOUT RETURN policy, partial histogram
+            # would underestimate selectivity
+            logger.warning(
+                'Timestamp histogram of %s is incomplete: %d of %d frames',
+                source_manager_id, sum(counts.values()), found[0],
+            )
+            return
+        connection.set(key, json.dumps({
+            'bucket': bucket,
+            'counts': sorted(counts.items()),
+            'num_docs': num_docs,
+            'computed_at': time.time(),
+        }), ex=10 * settings.web.hybrid_histogram_ttl)
+
+    def plan(self, top_k: int, source_manager_id: str,
+             time_start: Optional[float], time_end: Optional[float]) -> dict:
+        """
+        Choose hybrid policy of filtered KNN query by filter selectivity.
+
+        Number of frames passing the filter is estimated from the source
+        manager timestamp histogram, selectivity is its share of all frames
+        in the index. Small filtered sets are searched with
+        ad-hoc brute force, which is exact and cheaper than walking HNSW
+        graph. For larger ones HNSW is queried in batches, batch size is
+        chosen so a single batch is expected to contain all candidates
+        passing the filter, and EF_RUNTIME is raised to cover the batch.
+        """
+        candidates = self.candidates(top_k)
+        plan = {'candidates': candidates} if candidates != top_k else {}
+        if not settings.web.hybrid_planning:
+            return plan
+        if self.filter(source_manager_id, time_start, time_end) == '*':
+            return plan  # Pure KNN query, there is nothing to plan
+        shared = self.histogram(source_manager_id)
+        if shared is None:
+            return plan  # Histogram isn't computed yet
+        histogram, num_docs = shared
+        estimate = histogram.estimate(time_start, time_end)
+        plan['estimate'] = round(estimate)
+        plan['selectivity'] = \
+            min(estimate / num_docs, 1.0) if num_docs else 0.0
+        if estimate <= settings.web.hybrid_adhoc_bf_max:
+            plan['policy'] = 'ADHOC_BF'
+            return plan
+        batch_size = math.ceil(
+            candidates / plan['selectivity'] * settings.web.hybrid_batch_margin
+        )
+        batch_size = min(
+            max(batch_size, candidates), settings.web.hybrid_max_batch_size
+        )
+        plan['policy'] = 'BATCHES'
+        plan['batch_size'] = batch_size
+        plan['ef_runtime'] = max(settings.web.hnsw_ef_runtime, batch_size)
+        return plan
+
+    def search_args(self, query_embedding: bytes, top_k: int, filter: str,
+                    plan: dict, field: str = 'embedding') -> list:
+        """
+        Build FT.SEARCH arguments for filtered KNN query.
+        If vectors in the index are compressed, full-precision embeddings
+        are returned too, so candidates can be re-ranked.
+        """
+        return_fields = RETURN_FIELDS
+        if field != 'embedding':
+            return_fields += ('embedding',)
+        attributes = ''
+        if 'policy' in plan:
+            attributes += f' HYBRID_POLICY {plan["policy"]}'
+        if 'batch_size' in plan:
+            attributes += f' BATCH_SIZE {plan["batch_size"]}'
+        if 'ef_runtime' in plan:
+            attributes += f' EF_RUNTIME {plan["ef_runtime"]}'
+        if filter != '*':
+            filter = f'({filter})'
+        query = (
+            f'{filter}=>[KNN {top_k} @{field} $query_embedding'
+            f'{attributes} AS score]'
+        )
+        return [
+            'FT.SEARCH', self.index_name, query,
+            'RETURN', len(return_fields) + 1, *return_fields, 'score',
+            'SORTBY', 'score',
+            'LIMIT', 0, top_k,
+            'PARAMS', 2, 'query_embedding', query_embedding,
+            'DIALECT', 2,
+        ]
+
+    @staticmethod
+    def decode(reply: list) -> list[Frame]:
+        """
+        Decode raw FT.SEARCH reply.
+
+        Reply has form [total, key, [field, value, ...], key, [...], ...].
+        """
+        frames = []
+        for fields in reply[2::2]:
+            doc = dict(zip(fields[::2], fields[1::2]))
+            frames.append(Frame(
+                source_id=int(doc[b'source_id']),
+                chunk_id=int(doc[b'chunk_id']),
+                position=int(doc[b'position']),
+                timestamp=float(doc[b'timestamp']),
+                box=list(map(int, doc[b'box'].split(b','))),
+                score=float(doc[b'score']),
+            ))
+        return frames
+
+    def count(self, source_manager_id: str, time_start: Optional[float],
+              time_end: Optional[float]) -> int:
+        command = self.count_command(source_manager_id, time_start, time_end)
+        return self.count_reply(connection.execute_command(*command))
+
+    def count_command(self, source_manager_id: str,
+                      time_start: Optional[float],
+                      time_end: Optional[float]) -> Optional[tuple]:
+        filter = self.filter(source_manager_id, time_start, time_end)
+        return 'FT.SEARCH', self.index_name, filter, 'LIMIT', 0, 0
+
+    def count_reply(self, reply) -> int:
+        return reply[0]
+
+    def search_many(self, query_embeddings: list[bytes], top_k: int,
+                    source_manager_id: str, time_start: Optional[float],
+                    time_end: Optional[float]) -> list[list[Frame]]:
+        """
+        Find frames closest to each of the query embeddings.
+        All queries are sent in a single pipeline, so they cost one round
+        trip to Redis. Only fields needed to render results are fetched.
+        """
+        compressor = self.live_compressor()
+        if not compressor.load():
+            # Projection isn't fitted yet, so nothing is indexed either
+            return [[] for _ in query_embeddings]
+        filter = self.filter(source_manager_id, time_start, time_end)
+        plan = self.plan(top_k, source_manager_id, time_start, time_end)
+        logger.debug('Query plan for %s: %s', filter, plan)
+        candidates = plan.get('candidates', top_k)
+        queries = np.frombuffer(
+            b''.join(query_embeddings), dtype='float32'
+        ).reshape(-1, settings.web.hnsw_dim)
+        pipe = connection.pipeline(transaction=False)
+        for query in compressor(queries):
+            pipe.execute_command(*self.search_args(
+                query.tobytes(), candidates, filter, plan, compressor.field
+            ))
+        replies = pipe.execute()
+        if not compressor.compressed:
+            return [self.decode(reply) for reply in replies]
+        return [
+            self.rerank(reply, query, top_k)
+            for reply, query in zip(replies, queries)
+        ]
+
+    def rerank(self, reply: list, query: np.ndarray,
+               top_k: int) -> list[Frame]:
+        """Re-rank candidates exactly with full-precision embeddings."""
+        frames = self.decode(reply)
+        if not frames:
+            return frames
+        embeddings = np.frombuffer(b''.join(
+            dict(zip(fields[::2], fields[1::2]))[b'embedding']
+            for fields in reply[2::2]
+        ), dtype='float32').reshape(len(frames), -1)
+        scores = distances(embeddings, query[None])[:, 0]
+        for frame, score in zip(frames, scores):
+            frame.score = float(score)
+        frames.sort(key=lambda frame: frame.score)
+        return frames[:top_k]
+
+
+class PartitionedStore(RediSearchStore):
+    """
+    RediSearch indexes, one per source manager.
+
+    Frames of a source manager are expected under `frame:{client_id}:` key
+    prefix. Every source manager has its own versioned indexes behind
+    `frame_idx_{client_id}` alias, so HNSW graph search never walks frames
+    of other source managers and its latency depends on the source
+    manager's own data only. Index is created on registration, or lazily
+    on the first search, and dropped on unregistration.
+    """
+
+    source_managers_key = 'frame_idx:source_managers'
+
+    def __init__(self):
+        super().__init__()
+        self._partitions: dict[str, RediSearchStore] = {}
+        # Source manager id -> when its registration was last checked
+        self._checked_at: dict[str, float] = {}
+        self._partitions_lock = threading.Lock()
+
+    def partition(self, source_manager_id: str,
+                  create: bool = True) -> RediSearchStore:
+        """
+        Get store of the source manager frames.
+
+        Parameters:
+        - source_manager_id (str): id of the source manager
+        - create (bool): create index if it doesn't exist yet
+
+        Returns:
+        - RediSearchStore: store of the source manager frames
+        """
+        store = self._partitions.get(source_manager_id)
+        if store is not None:
+            # Other worker may have unregistered the source manager and
+            # dropped its index, then the index has to be created again.
+            # Checked once per `field_ttl`, to keep searches at one round
+            # trip to Redis
+            checked_at = self._checked_at.get(source_manager_id, 0)
+            if time.monotonic() - checked_at < self.field_ttl:
+                return store
+            if connection.sismember(
+                self.source_managers_key, source_manager_id
+            ):
+                self._checked_at[source_manager_id] = time.monotonic()
+                return store
+            with self._partitions_lock:
+                if self._partitions.get(source_manager_id) is store:
+                    del self._partitions[source_manager_id]
+        store = RediSearchStore(
+            index_name=f'frame_idx_{source_manager_id}',
+            prefix=f'frame:{source_manager_id}:',
+            tenant=source_manager_id,
+        )
+        if not create:
+            return store
+        with self._partitions_lock:
+            if source_manager_id not in self._partitions:
+                store.create_index()
+                connection.sadd(self.source_managers_key, source_manager_id)
+                self._partitions[source_manager_id] = store
+                self._checked_at[source_manager_id] = time.monotonic()
+        return self._partitions[source_manager_id]
+
+    def source_managers(self) -> list[str]:
+        """Get ids of source managers which have an index."""
+        return sorted(
+            id.decode()
+            for id in connection.smembers(self.source_managers_key)
+        )
+
+    def create_index(self):
+        """Start compressing frames, indexes are created per partition."""
+        if not self._compressing:
+            self._compressing = True
+            threading.Thread(
+                target=self._compress_loop, name='compress', daemon=True
+            ).start()
+
+    def live_compressor(self) -> Compressor:
+        return self.compressor
+
+    def register(self, source_manager_id: str):
+        self.partition(source_manager_id)
+
+    def unregister(self, source_manager_id: str):
+        self.partition(source_manager_id, create=False).drop()
+        connection.srem(self.source_managers_key, source_manager_id)
+        self._partitions.pop(source_manager_id, None)
+        self._checked_at.pop(source_manager_id, None)
+
+    def reindex(self, wait: bool = True) -> bool:
+        """
+        Rebuild indexes of all source managers, see `RediSearchStore`.
+
+        Returns:
+        - bool: False if rebuild of some index is already running
+        """
+        started = [
+            self.partition(id).reindex(wait)
+            for id in self.source_managers()
+        ]
+        return all(started)
+
+    def info(self, source_manager_id: Optional[str] = None) -> dict:
+        if source_manager_id is not None:
+            return self.partition(source_manager_id, create=False).info()
+        return {
+            id: self.partition(id, create=False).info()
+            for id in self.source_managers()
+        }
+
+    def plan(self, top_k: int, source_manager_id: str,
+             time_start: Optional[float], time_end: Optional[float]) -> dict:
+        return self.partition(source_manager_id).plan(
+            top_k, source_manager_id, time_start, time_end
+        )
+
+    def count(self, source_manager_id: str, time_start: Optional[float],
+              time_end: Optional[float]) -> int:
+        return self.partition(source_manager_id).count(
+            source_manager_id, time_start, time_end
+        )
+
+    def count_command(self, source_manager_id: str,
+                      time_start: Optional[float],
+                      time_end: Optional[float]) -> Optional[tuple]:
+        return self.partition(source_manager_id).count_command(
+            source_manager_id, time_start, time_end
+        )
+
+    def search_many(self, query_embeddings: list[bytes], top_k: int,
+                    source_manager_id: str, time_start: Optional[float],
+                    time_end: Optional[float]) -> list[list[Frame]]:
+        return self.partition(source_manager_id).search_many(
+            query_embeddings, top_k, source_manager_id, time_start, time_end
+        )
+
+
+class FlatStore(VectorStore):
+    """
+    Exact brute-force search over a memory-mapped float32 matrix.
+
+    Embeddings are kept in a single row-major matrix file and frame
+    metadata in one file per column, all of them memory-mapped and grown
+    by doubling. Filters are evaluated as vectorized masks over metadata
+    columns, distances are computed with a matrix product over chunks of
+    rows and top-k is selected with `argpartition`.
+
+    Store is filled from frame hashes in Redis, new frames are imported in
+    background at most once per `flat_sync_interval` seconds. Several
+    processes may share the same directory: only one of them imports at a
+    time, holding a file lock, and the others remap the files when it
+    grows them. Searches never wait for an import. Frames
+    deleted from Redis are not removed, delete the directory to rebuild
+    the store from scratch.
+
+    It needs neither RediSearch nor any index building, so it serves as
+    a ground truth for approximate indexes and as a simple option for
+    small installations.
+
+    Attributes:
+    - path (Path): directory with store files
+    - dim (int): embedding dimension
+    """
+
+    # Column name -> (dtype, shape of a single row)
+    COLUMNS = {
+        'embedding': ('float32', (settings.web.hnsw_dim,)),
+        'source_manager': ('int32', ()),
+        'source_id': ('int64', ()),
+        'chunk_id': ('int64', ()),
+        'position': ('int64', ()),
+        'timestamp': ('float64', ()),
+        'box': ('int32', (4,)),
+    }
+
+    def __init__(self, path: Path, dim: int):
+        self.path = Path(path)
+        self.dim = dim
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.size = 0
+        self.capacity = 0
+        self.source_managers: dict[str, int] = {}
+        self.columns: dict[str, np.memmap] = {}
+        self._keys: set[bytes] = set()
+        self._keys_read = 0
+        self._meta_mtime = None
+        self._synced_at = 0.0
+        self._syncing = False
+        self._lock = threading.RLock()
+
+    @property
+    def _meta_path(self) -> Path:
+        return self.path / 'meta.json'
+
+    @property
+    def _keys_path(self) -> Path:
+        return self.path / 'keys.txt'
+
+    def _column_path(self, name: str) -> Path:
+        return self.path / f'{name}.bin'
+
+    def _map(self):
+        """Memory-map column files with current capacity."""
+        columns = {}
+        if self.capacity > 0:
+            for name, (dtype, shape) in self.COLUMNS.items():
+                columns[name] = np.memmap(
+                    self._column_path(name), dtype=dtype, mode='r+',
+                    shape=(self.capacity, *shape),
+                )
+        # Searches read columns without the lock, replace them at once
+        self.columns = columns
+
+    def _snapshot(self) -> tuple[dict[str, np.memmap], int]:
+        """
+        Get columns and number of rows searches may read, while import
+        may be running in background. Columns are grown before size is
+        increased, so columns read after size always cover it.
+        """
+        size = self.size
+        return self.columns, size
+
+    def _reload(self):
+        """Reload store state if other process has changed it."""
+        try:
+            mtime = self._meta_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._meta_mtime:
+            return
+        meta = json.loads(self._meta_path.read_text())
+        if meta['dim'] != self.dim:
+            raise RuntimeError(
+                f'Flat store at {self.path} has dimension {meta["dim"]}, '
+                f'expected {self.dim}'
+            )
+        if meta['capacity'] != self.capacity:
+            self.capacity = meta['capacity']
+            self._map()
+        # Keys file is append-only, only keys added since last reload are read
+        with open(self._keys_path, 'rb') as f:
+            f.seek(self._keys_read)
+            keys = f.read(meta['keys_size'] - self._keys_read)
+        self._keys.update(keys.split())
+        self._keys_read = meta['keys_size']
+        self.size = meta['size']
+        self.source_managers = {
+            name: i for i, name in enumerate(meta['source_managers'])
+        }
+        self._meta_mtime = mtime
+
+    def _save(self):
+        """Flush columns and atomically publish new store state."""
+        for column in self.columns.values():
+            column.flush()
+        meta = {
+            'dim': self.dim,
+            'size': self.size,
+            'capacity': self.capacity,
+            'source_managers': list(self.source_managers),
+            'keys_size': self._keys_read,
+        }
+        tmp_path = self._meta_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(meta))
+        os.replace(tmp_path, self._meta_path)
+        self._meta_mtime = self._meta_path.stat().st_mtime_ns
+
+    def _reserve(self, n: int):
+        """Grow column files, so `n` more rows fit in."""
+        if self.size + n <= self.capacity:
+            return
+        capacity = max(self.capacity * 2, self.size + n, 1024)
+        for name, (dtype, shape) in self.COLUMNS.items():
+            row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+            with open(self._column_path(name), 'ab') as f:
+                f.truncate(capacity * row_bytes)
+        self.capacity = capacity
+        self._map()
+
+    def add(self, keys: list[bytes], frames: list[dict]):
+        """
+        Append frames to the store.
+        Must be called with the file lock held, see `sync`.
+
+        Parameters:
+        - keys (list[bytes]): Redis keys of the frames
+        - frames (list[dict]): frame fields, as stored in Redis hashes
+        """
+        if not frames:
+            return
+        self._reserve(len(frames))
+        rows = slice(self.size, self.size + len(frames))
+        codes = []
+        for frame in frames:
+            name = frame['source_manager_id']
+            if name not in self.source_managers:
+                self.source_managers[name] = len(self.source_managers)
+            codes.append(self.source_managers[name])
+        columns = self.columns
+        columns['embedding'][rows] = np.frombuffer(
+            b''.join(frame['embedding'] for frame in frames),
+            dtype='float32',
+        ).reshape(-1, self.dim)
+        columns['source_manager'][rows] = codes
+        for name in ('source_id', 'chunk_id', 'position', 'timestamp'):
+            columns[name][rows] = [frame[name] for frame in frames]
+        columns['box'][rows] = [
+            list(map(int, frame['box'].split(','))) for frame in frames
+        ]
+        with open(self._keys_path, 'ab') as f:
+            f.write(b''.join(key + b'\n' for key in keys))
+            self._keys_read = f.tell()
+        self.size += len(frames)
+        self._keys.update(keys)
+        self._save()
+
+    def sync(self, batch_size: int = 1000, blocking: bool = True) -> bool:
+        """
+        Import frames which are in Redis, but not in the store yet.
+
+        Parameters:
+        - batch_size (int): number of frames fetched in one pipeline
+        - blocking (bool): wait if other process is importing, otherwise
+            only reload the store and return
+
+        Returns:
+        - bool: True if import was done by this call
+        """
+        fields = ('source_manager_id', 'source_id', 'chunk_id', 'position',
+                  'timestamp', 'box', 'embedding')
+        with self._lock, open(self.path / 'lock', 'w') as lock:
+            try:
+                fcntl.flock(
+                    lock, fcntl.LOCK_EX if blocking
+                    else fcntl.LOCK_EX | fcntl.LOCK_NB
+                )
+            except BlockingIOError:
+                self._reload()
+                return False
+            self._reload()
+            keys = [
+                key for key in connection.scan_iter('frame:*', batch_size)
+                if key not in self._keys
+            ]
+            for i in range(0, len(keys), batch_size):
+                batch = keys[i:i + batch_size]
+                pipe = connection.pipeline(transaction=False)
+                for key in batch:
+                    pipe.hmget(key, fields)
+                frames, found = [], []
+                for key, values in zip(batch, pipe.execute()):
+                    if values[-1] is None:
+                        continue  # Deleted in the meantime
+                    frame = dict(zip(fields, values))
+                    for name in fields[:-1]:
+                        frame[name] = frame[name].decode()
+                    frames.append(frame)
+                    found.append(key)
+                self.add(found, frames)
+            if keys:
+                logger.info('Imported %d frames into flat store', len(keys))
+        self._synced_at = time.monotonic()
+        return True
+
+    def _sync_background(self):
+        try:
+            self.sync(blocking=False)
+        except Exception:
+            logger.exception('Failed to import frames into flat store')
+        finally:
+            # Also after failure, so it's not retried by every search
+            self._synced_at = time.monotonic()
+            self._syncing = False
+
+    def _refresh(self):
+        """
+        Pick up frames imported by other processes and start import of new
+        frames in background if sync interval has passed.
+        """
+        # While this process imports, its state is updated by the import
+        if self._lock.acquire(blocking=False):
+            try:
+                self._reload()
+            finally:
+                self._lock.release()
+        interval = settings.web.flat_sync_interval
+        if (not self._syncing
+                and time.monotonic() - self._synced_at >= interval):
+            self._syncing = True
+            threading.Thread(
+                target=self._sync_background, name='flat-sync', daemon=True
+            ).start()
+
+    def create_index(self):
+        # Frames are imported by the first search, in background
+        with self._lock:
+            self._reload()
+
+    def info(self, source_manager_id: Optional[str] = None) -> dict:
+        return {'size': self.size, 'capacity': self.capacity}
+
+    def plan(self, top_k: int, source_manager_id: str,
+             time_start: Optional[float], time_end: Optional[float]) -> dict:
+        return {'policy': 'FLAT'}
+
+    def _mask(self, columns: dict[str, np.memmap], rows: slice,
+              source_manager_id: str, time_start: Optional[float],
+              time_end: Optional[float]) -> Optional[np.ndarray]:
+        """Evaluate filters over a range of rows."""
+        code = self.source_managers.get(source_manager_id)
+        if code is None:
+            return None
+        mask = columns['source_manager'][rows] == code
+        timestamp = columns['timestamp'][rows]
+        if time_start is not None:
+            mask &= timestamp >= time_start
+        if time_end is not None:
+            mask &= timestamp <= time_end
+        return mask
+
+    def count(self, source_manager_id: str, time_start: Optional[float],
+              time_end: Optional[float]) -> int:
+        self._refresh()
+        columns, size = self._snapshot()
+        if size == 0:
+            return 0
+        mask = self._mask(
+            columns, slice(0, size), source_manager_id, time_start, time_end
+        )
+        return 0 if mask is None else int(mask.sum())
+
+    def search_many(self, query_embeddings: list[bytes], top_k: int,
+                    source_manager_id: str, time_start: Optional[float],
+                    time_end: Optional[float]) -> list[list[Frame]]:
+        self._refresh()
+        queries = np.frombuffer(
+            b''.join(query_embeddings), dtype='float32'
+        ).reshape(-1, self.dim)
+        n_queries = len(queries)
+        # Running top-k candidates of every query: row ids and scores
+        best_ids = np.empty((0, n_queries), dtype='int64')
+        best_scores = np.empty((0, n_queries), dtype='float32')
+        chunk_size = settings.web.flat_chunk_size
+        columns, size = self._snapshot()
+        for start in range(0, size, chunk_size):
+            rows = slice(start, min(start + chunk_size, size))
+            mask = self._mask(
+                columns, rows, source_manager_id, time_start, time_end
+            )
+            if mask is None:
+                break
+            ids = np.flatnonzero(mask)
+            if ids.size == 0:
+                continue
+            scores = distances(columns['embedding'][rows][ids], queries)
+            ids = np.broadcast_to((ids + start)[:, None], scores.shape)
+            best_ids = np.concatenate([best_ids, ids])
+            best_scores = np.concatenate([best_scores, scores])
+            if len(best_ids) > top_k:
+                top = np.argpartition(best_scores, top_k - 1, axis=0)[:top_k]
+                best_ids = np.take_along_axis(best_ids, top, axis=0)
+                best_scores = np.take_along_axis(best_scores, top, axis=0)
+
+        order = np.argsort(best_scores, axis=0, kind='stable')
+        best_ids = np.take_along_axis(best_ids, order, axis=0)
+        best_scores = np.take_along_axis(best_scores, order, axis=0)
+        results = []
+        for q in range(n_queries):
+            frames = []
+            for i, score in zip(best_ids[:, q], best_scores[:, q]):
+                frames.append(Frame(
+                    source_id=int(columns['source_id'][i]),
+                    chunk_id=int(columns['chunk_id'][i]),
+                    position=int(columns['position'][i]),
+                    timestamp=float(columns['timestamp'][i]),
+                    box=columns['box'][i].tolist(),
+                    score=float(score),
+                ))
+            results.append(frames)
+        return results
+
+
+def create(name: str) -> VectorStore:
+    """
+    Create vector store.
+
+    Parameters:
+    - name (str): store name, one of 'redisearch',
+        'redisearch-partitioned', 'flat'
+
+    Returns:
+    - VectorStore: vector store
+    """
+    if name == 'redisearch':
+        return RediSearchStore()
+    if name == 'redisearch-partitioned':
+        return PartitionedStore()
+    if name == 'flat':
+        return FlatStore(settings.web.flat_store_dir, settings.web.hnsw_dim)
+    raise ValueError(f'Unknown vector store {name}')
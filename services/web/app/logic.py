@@ -38,6 +38,8 @@ def render(template: str, endpoint: str = None):
     Decorator for rendering templates.
     On HTTPError, renders error.html template.
     Pulls data from session if endpoint is specified.
+    Request arguments override session data, but not values returned by
+    the view, so links and markup it computed can't be replaced.
 
     Args:
         template: Template to render.
@@ -49,10 +51,12 @@ def render(template: str, endpoint: str = None):
             try:
                 res = func(*args, **kwargs)
                 res = res if isinstance(res, dict) else {}
+                data = {}
                 if endpoint and endpoint in session:
-                    res.update(session[endpoint])
-                res.update(request.args)
-                return render_template(template, **res)
+                    data.update(session[endpoint])
+                data.update(request.args)
+                data.update(res)
+                return render_template(template, **data)
             except HTTPError as e:
                 error = f'HTTPError: {e.status} {e.msg}'
                 return render_template('error.html', error=error)
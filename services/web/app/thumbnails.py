@@ -0,0 +1,432 @@
+from collections import OrderedDict
+from hashlib import sha1
+from pathlib import Path
+from typing import Callable, Optional
+import io
+import logging
+import math
+import os
+import threading
+import time
+
+from PIL import Image
+from redis.exceptions import RedisError
+
+from common.config import settings
+from common.utils.frontend import draw_bounding_box
+from app.clients import source_manager
+from app.database import connection
+
+
+logger = logging.getLogger(__name__)
+
+
+BOX_COLOR = (255, 0, 0)
+BOX_WIDTH = 3
+MIMETYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+# Seconds after which browser asks again for an image being prefetched
+PREFETCH_RETRY_AFTER = 1
+
+
+class Pending(Exception):
+    """Raised when image is being prefetched by another request."""
+
+
+class MemoryCache:
+    """
+    Thread-safe LRU cache of rendered images bounded by their total size.
+
+    Attributes:
+    - max_bytes (int): maximum total size of cached images, least recently
+        used images are evicted first
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._data[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class DiskCache:
+    """
+    Cache of rendered images in a directory shared by all workers.
+
+    Images are written atomically, reads refresh file modification time.
+    When total size of the directory exceeds `max_bytes`, least recently
+    used files are removed until it's below 90% of the limit. Size of the
+    directory is counted on first use and on every eviction, between them
+    it's tracked by the worker itself, so writes of other workers are
+    noticed with a delay.
+
+    Attributes:
+    - path (Path): cache directory
+    - max_bytes (int): maximum total size of cached images
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _file(self, key: str) -> Path:
+        return self.path / key[:2] / key
+
+    def _files(self) -> list[tuple[float, int, Path]]:
+        files = []
+        for file in self.path.glob('*/*'):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue  # Evicted by another worker
+            files.append((stat.st_mtime, stat.st_size, file))
+        return files
+
+    def __contains__(self, key: str) -> bool:
+        return self._file(key).exists()
+
+    def get(self, key: str) -> Optional[bytes]:
+        file = self._file(key)
+        try:
+            value = file.read_bytes()
+            os.utime(file)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def set(self, key: str, value: bytes):
+        file = self._file(key)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_name(f'.{key}.{os.getpid()}.{threading.get_ident()}')
+        tmp.write_bytes(value)
+        os.replace(tmp, file)
+        with self._lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._files())
+            else:
+                self.size += len(value)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = sorted(self._files())
+        self.size = sum(size for _, size, _ in files)
+        for _, size, file in files:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+memory_cache = MemoryCache(settings.web.thumbnail_cache_memory_size)
+disk_cache = DiskCache(
+    settings.paths.media_dir / 'thumbnails',
+    settings.web.thumbnail_cache_disk_size,
+)
+cache_stats = {
+    'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'errors': 0,
+    'prefetched': 0, 'render_seconds_total': 0.0,
+}
+
+
+def render_params() -> str:
+    """Parameters of rendered images, part of every cache key."""
+    return '{}:{}:{}x{}:{}:{}'.format(
+        settings.web.thumbnail_format,
+        settings.web.thumbnail_quality,
+        settings.web.thumbnail_max_width,
+        settings.web.thumbnail_max_height,
+        ','.join(map(str, BOX_COLOR)),
+        BOX_WIDTH,
+    )
+
+
+def cache_key(source_manager_id: str, chunk_id: int, position: int,
+              box: list[int]) -> str:
+    """
+    Get cache key of a rendered frame.
+    Key depends only on the frame and render parameters, so it's also used
+    as ETag of the image.
+
+    Parameters:
+    - source_manager_id (str): id of the source manager frame belongs to
+    - chunk_id (int): id of the video chunk frame belongs to
+    - position (int): frame position in the video chunk
+    - box (list[int]): bounding box coordinates (xyxy)
+
+    Returns:
+    - str: cache key
+    """
+    key = ':'.join(map(str, (
+        source_manager_id, chunk_id, position, ','.join(map(str, box)),
+        render_params(),
+    )))
+    return sha1(key.encode()).hexdigest()
+
+
+def mimetype() -> str:
+    """Mimetype of rendered images."""
+    return MIMETYPES[settings.web.thumbnail_format]
+
+
+def cache_info() -> dict:
+    """
+    Get thumbnail cache statistics for the current worker.
+
+    Returns:
+    - dict: hit/miss counters, hit rate, time spent fetching and rendering
+        missed images and sizes of the cache tiers
+    """
+    info = dict(cache_stats)
+    hits = info['memory_hits'] + info['disk_hits']
+    total = hits + info['misses']
+    info['hit_rate'] = hits / total if total else 0.0
+    info['memory_entries'] = len(memory_cache)
+    info['memory_bytes'] = memory_cache.size
+    info['disk_bytes'] = disk_cache.size
+    return info
+
+
+def render(image_data: bytes, box: list[int]) -> bytes:
+    """
+    Downscale frame to fit into thumbnail size and draw bounding box on it.
+
+    JPEG frames are decoded right at a reduced scale with `draft`, other
+    frames are shrunk by an integer factor with `reduce`, which is much
+    faster than resampling. Only the remaining small difference is
+    resampled. Box is drawn after downscaling, with scaled coordinates, so
+    its line width doesn't depend on the frame size.
+
+    Parameters:
+    - image_data (bytes): encoded frame
+    - box (list[int]): bounding box coordinates (xyxy) in the frame
+
+    Returns:
+    - bytes: image in `thumbnail_format`
+    """
+    image = Image.open(io.BytesIO(image_data))
+    width, height = image.size
+    max_size = (settings.web.thumbnail_max_width,
+                settings.web.thumbnail_max_height)
+    scale = min(max_size[0] / width, max_size[1] / height, 1)
+    size = (max(round(width * scale), 1), max(round(height * scale), 1))
+    image.draft('RGB', size)
+    factor = min(image.width // size[0], image.height // size[1])
+    if factor > 1:
+        image = image.reduce(factor)
+    if image.size != size:
+        image = image.resize(size, Image.BILINEAR)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    scale_x, scale_y = size[0] / width, size[1] / height
+    box = [
+        round(box[0] * scale_x), round(box[1] * scale_y),
+        round(box[2] * scale_x), round(box[3] * scale_y),
+    ]
+    draw_bounding_box(image, box, BOX_COLOR, BOX_WIDTH)
+
+    encoded = io.BytesIO()
+    if settings.web.thumbnail_format == 'PNG':
+        image.save(encoded, format='PNG')
+    else:
+        image.save(encoded, format=settings.web.thumbnail_format,
+                   quality=settings.web.thumbnail_quality)
+    return encoded.getvalue()
+
+
+def get_many(
+    source_manager_id: str,
+    frames: list[tuple[int, int, list[int]]],
+) -> list[Optional[bytes]]:
+    """
+    Get rendered images of found frames.
+
+    Images are looked up in the per-worker memory cache first, then in
+    the disk cache shared by all workers. Only images missing in both of
+    them are fetched from the source manager and rendered. Disk failures
+    are treated as misses.
+
+    Parameters:
+    - source_manager_id (str): id of the source manager frames belong to
+    - frames (list[tuple[int, int, list[int]]]): chunk ids, frame
+        positions and bounding boxes of found frames
+
+    Returns:
+    - list[Optional[bytes]]: rendered images, None for frames which
+        failed to load
+    """
+    if not settings.web.thumbnail_cache_enabled:
+        images = source_manager.videos.get_frames(
+            [(chunk_id, position) for chunk_id, position, _ in frames]
+        )
+        return [
+            render(image, box) if image is not None else None
+            for (_, _, box), image in zip(frames, images)
+        ]
+
+    keys = [cache_key(source_manager_id, *frame) for frame in frames]
+    images = [memory_cache.get(key) for key in keys]
+    cache_stats['memory_hits'] += sum(i is not None for i in images)
+    for i, key in enumerate(keys):
+        if images[i] is not None:
+            continue
+        try:
+            images[i] = disk_cache.get(key)
+        except OSError:
+            cache_stats['errors'] += 1
+        if images[i] is not None:
+            cache_stats['disk_hits'] += 1
+            memory_cache.set(key, images[i])
+
+    missing = [i for i, image in enumerate(images) if image is None]
+    if not missing:
+        return images
+    cache_stats['misses'] += len(missing)
+    start = time.perf_counter()
+    fetched = source_manager.videos.get_frames(
+        [frames[i][:2] for i in missing]
+    )
+    for i, image_data in zip(missing, fetched):
+        if image_data is None:
+            continue
+        images[i] = render(image_data, frames[i][2])
+        memory_cache.set(keys[i], images[i])
+        try:
+            disk_cache.set(keys[i], images[i])
+        except OSError:
+            cache_stats['errors'] += 1
+    cache_stats['render_seconds_total'] += time.perf_counter() - start
+    return images
+
+
+def _pending_key(key: str) -> str:
+    return f'thumbnail_pending:{key}'
+
+
+def prefetch(
+    source_manager_id: str,
+    frames: list[tuple[int, int, list[int]]],
+) -> Optional[Callable[[], None]]:
+    """
+    Reserve images of found frames missing in the cache for prefetching.
+
+    Search page only references images of found frames, browser requests
+    them one by one. To fetch frames of the same chunk with one request,
+    images of the whole page are fetched with `get_many` right after the
+    page is sent. Reserved images are marked in Redis, so image requests
+    which arrive in the meantime, in any worker, are answered right away
+    with `Pending` instead of fetching the frames themselves, and browser
+    asks for them again later.
+
+    Parameters:
+    - source_manager_id (str): id of the source manager frames belong to
+    - frames (list[tuple[int, int, list[int]]]): chunk ids, frame
+        positions and bounding boxes of found frames
+
+    Returns:
+    - Optional[Callable[[], None]]: function which fetches and caches
+        reserved images, it must be called while source manager session
+        still has credentials of the user. None if there is nothing to
+        prefetch.
+    """
+    if not settings.web.thumbnail_cache_enabled:
+        return None
+    missing = []
+    for frame in frames:
+        key = cache_key(source_manager_id, *frame)
+        if memory_cache.get(key) is None and key not in disk_cache:
+            missing.append((frame, key))
+    if not missing:
+        return None
+    # Markers outlive the slowest prefetch: a round of multi-frame
+    # requests and a round of single-frame retries
+    rounds = math.ceil(len(missing) / settings.web.frame_fetch_concurrency)
+    ttl = math.ceil(2 * rounds * settings.web.frame_fetch_timeout) + 1
+    pipe = connection.pipeline(transaction=False)
+    for _, key in missing:
+        pipe.set(_pending_key(key), 1, nx=True, ex=ttl)
+    try:
+        reserved = pipe.execute()
+    except RedisError as e:
+        logger.warning('Failed to reserve images for prefetch: %s', e)
+        return None
+    # Images reserved by other searches are prefetched by them
+    missing = [item for item, ok in zip(missing, reserved) if ok]
+    if not missing:
+        return None
+
+    def prefetch_images():
+        try:
+            get_many(source_manager_id, [frame for frame, _ in missing])
+            cache_stats['prefetched'] += len(missing)
+        except Exception:
+            logger.exception('Failed to prefetch images')
+        finally:
+            try:
+                connection.delete(*[_pending_key(key) for _, key in missing])
+            except RedisError:
+                pass  # Markers expire anyway
+
+    return prefetch_images
+
+
+def _is_pending(key: str) -> bool:
+    """Check if image is reserved by `prefetch` and not cached yet."""
+    if key in disk_cache:
+        return False
+    try:
+        return bool(connection.exists(_pending_key(key)))
+    except RedisError:
+        return False
+
+
+def get(source_manager_id: str, chunk_id: int, position: int,
+        box: list[int]) -> Optional[bytes]:
+    """
+    Get rendered image of a found frame, see `get_many`.
+
+    Parameters:
+    - source_manager_id (str): id of the source manager frame belongs to
+    - chunk_id (int): id of the video chunk frame belongs to
+    - position (int): frame position in the video chunk
+    - box (list[int]): bounding box coordinates (xyxy)
+
+    Returns:
+    - Optional[bytes]: rendered image, None if frame failed to load
+
+    Raises:
+    - Pending: if the image is being prefetched, see `prefetch`
+    """
+    if settings.web.thumbnail_cache_enabled:
+        key = cache_key(source_manager_id, chunk_id, position, box)
+        if memory_cache.get(key) is None and _is_pending(key):
+            raise Pending()
+    return get_many(source_manager_id, [(chunk_id, position, box)])[0]